@@ -1,2 +1,5 @@
 #coding=utf8
 __author__ = 'liming'
+
+from .bibi import Generator, BuildError, build_selector
+from .content import ContentRenderer, register_renderer
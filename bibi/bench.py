@@ -0,0 +1,251 @@
+#coding=utf8
+"""
+性能基准: 生成指定规模的模拟站点, 测量冷启动, 无修改和修改单篇文章三种构建
+"""
+__author__ = 'liming'
+
+import os
+import zlib
+import random
+import struct
+import shutil
+import datetime
+import tempfile
+import platform
+import multiprocessing
+from timeit import default_timer
+
+import click
+
+from .bibi import (Generator, peak_rss, SITE_FOLDER, POSTS_FOLDER, LAYOUTS_FOLDER,
+                   INCLUDE_FOLDER, ASSETS_FOLDER, CONFIG)
+
+
+WORDS = ('static site generator markdown template layout include paginator archive '
+         'python jinja build cache index render output asset image post page tag').split()
+CJK_WORDS = u'静态 博客 生成 模板 文章 分页 归档 标签 缓存 索引 渲染 输出 图片 页面'.split()
+
+LAYOUTS = {
+    'base.html': u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{{ page.title }} - {{ site.site_name }}</title></head>
+<body>{% include "sidebar.html" %}<main>{{ content }}</main></body></html>
+""",
+    'default.html': u"""---
+layout: base
+---
+<div class="page">{{ content }}</div>
+""",
+    'post.html': u"""---
+layout: default
+---
+<article><h1>{{ post.title }}</h1><p>{{ post.date | date_to_string }} {{ post.author }}</p>
+{% if post.page_image %}<img src="{{ post.page_image }}">{% endif %}
+{{ content }}</article>
+""",
+}
+
+INCLUDES = {
+    'sidebar.html': u"""<aside><ul>{% for p in site.posts | limit(10) %}<li><a href="{{ p.url }}">{{ p.title }}</a></li>{% endfor %}</ul>
+<ul>{% for a in site.archives | limit(12) %}<li><a href="/archive/archive_{{ a }}.html">{{ a }}</a></li>{% endfor %}</ul></aside>
+""",
+}
+
+PAGES = {
+    'index.html': u"""---
+layout: default
+title: home
+page_size: 10
+---
+{% for post in paginator.posts %}<section><a href="{{ post.url }}">{{ post.title }}</a>
+{% if post.page_image %}<img src="{{ post.page_image | thumbnail }}" srcset="{{ post.page_image | srcset }}">{% endif %}
+<p>{{ post.description }}</p></section>{% endfor %}
+""",
+    'archive.html': u"""---
+layout: default
+title: archive
+---
+<h2>{{ archive.category }}</h2>{% for post in archive.posts %}<a href="{{ post.url }}">{{ post.title }}</a>{% endfor %}
+""",
+    'about.html': u"""---
+layout: default
+title: about
+---
+<p>synthetic benchmark site</p>
+""",
+}
+
+
+def _write(path, text):
+    dir_path = os.path.dirname(path)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    with open(path, 'wb') as f:
+        f.write(text.encode('utf-8'))
+
+
+def _png(rnd, width, height):
+    """
+    生成可解码的RGB格式png: 每行一种颜色, 再加一段随机像素
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    noise = width // 8
+    rows = []
+    for y in range(height):
+        color = struct.pack('BBB', (y * 255) // height, rnd.randint(0, 255), 128)
+        pixels = b''.join(struct.pack('<I', rnd.getrandbits(24))[:3] for _ in range(noise))
+        rows.append(b'\x00' + pixels + color * (width - noise))
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(b''.join(rows), 6)),
+                     chunk(b'IEND', b'')])
+
+
+def _sentence(rnd):
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(8, 20))]
+    if rnd.random() < 0.3:
+        words.append(u''.join(rnd.choice(CJK_WORDS) for _ in range(rnd.randint(2, 6))))
+    return u' '.join(words).capitalize() + u'.'
+
+
+def _post_body(rnd, idx, images):
+    lines = []
+    if images:
+        lines.append(u'![cover](/img/%s)' % rnd.choice(images))
+        lines.append(u'')
+    for section in range(rnd.randint(2, 5)):
+        lines.append(u'## Section %s' % (section + 1))
+        lines.append(u'')
+        for _ in range(rnd.randint(1, 4)):
+            lines.append(u' '.join(_sentence(rnd) for _ in range(rnd.randint(2, 6))))
+            lines.append(u'')
+        if rnd.random() < 0.3:
+            lines.extend([u'    def post_%s():' % idx, u'        return %s' % section, u''])
+        if rnd.random() < 0.3:
+            lines.extend([u'* %s' % rnd.choice(WORDS) for _ in range(3)] + [u''])
+    return u'\n'.join(lines)
+
+
+def make_site(root, posts, tags=30, images=20, seed=0, resize=False):
+    """
+    生成模拟站点
+    :param root: 站点目录, 已存在时先删除
+    :param posts: 文章数
+    :param tags: 标签总数
+    :param images: _assets/img中的图片数
+    :param seed: 随机种子, 相同参数生成相同的站点
+    :param resize: 是否开启images, 为文章图片生成衍生图
+    """
+    rnd = random.Random(seed)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    for folder in (POSTS_FOLDER, LAYOUTS_FOLDER, INCLUDE_FOLDER, SITE_FOLDER, ASSETS_FOLDER):
+        os.makedirs(os.path.join(root, folder))
+    _write(os.path.join(root, CONFIG), u'site_name: bench\npaginate: 10\n' + (u'images: true\n' if resize else u''))
+    for name, text in LAYOUTS.items():
+        _write(os.path.join(root, LAYOUTS_FOLDER, name), text)
+    for name, text in INCLUDES.items():
+        _write(os.path.join(root, INCLUDE_FOLDER, name), text)
+    for name, text in PAGES.items():
+        _write(os.path.join(root, name), text)
+    image_names = []
+    os.makedirs(os.path.join(root, ASSETS_FOLDER, 'img'))
+    for idx in range(images):
+        name = 'image-%03d.png' % idx
+        image_names.append(name)
+        with open(os.path.join(root, ASSETS_FOLDER, 'img', name), 'wb') as f:
+            f.write(_png(rnd, rnd.randint(400, 1600), rnd.randint(300, 900)))
+    _write(os.path.join(root, ASSETS_FOLDER, 'css', 'site.css'), u'body { font-family: sans-serif; }\n')
+
+    tag_names = [u'tag%s' % idx for idx in range(tags)]
+    start = datetime.date(2010, 1, 1)
+    for idx in range(posts):
+        date = start + datetime.timedelta(days=idx * 3650 // max(posts, 1))
+        file_name = '%04d-%02d-%02d-post-%06d.md' % (date.year, date.month, date.day, idx)
+        header = u'---\nlayout: post\ntitle: Post %s %s\nauthor: author%s\ntags: %s\ncategory: c%s\n---\n' % (
+            idx, rnd.choice(WORDS), idx % 5, u','.join(rnd.sample(tag_names, min(3, tags))), idx % 4)
+        _write(os.path.join(root, POSTS_FOLDER, file_name), header + _post_body(rnd, idx, image_names))
+    return root
+
+
+def edit_post(root, seed=0):
+    """
+    修改一篇文章的正文, 模拟一次编辑
+    """
+    post_dir = os.path.join(root, POSTS_FOLDER)
+    names = sorted(os.listdir(post_dir))
+    path = os.path.join(post_dir, names[len(names) // 2])
+    with open(path, 'ab') as f:
+        f.write((u'\nEdited paragraph %s.\n' % seed).encode('utf-8'))
+    return path
+
+
+def _build(root, jobs, conn):
+    """
+    在子进程中构建, 保证每次测量的内存峰值互不影响
+    """
+    start = default_timer()
+    generator = Generator(jobs=jobs, root=root, echo=lambda message: None)
+    generator.build()
+    conn.send(dict(seconds=default_timer() - start, peak_rss=peak_rss(), stats=generator.stats))
+    conn.close()
+
+
+def run_build(root, jobs=1):
+    """
+    :return: 构建耗时, 内存峰值和生成统计
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_build, args=(root, jobs, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError('build exited with %s' % process.exitcode)
+    return result
+
+
+def run_benchmark(root, posts, jobs=1, seed=0, resize=False):
+    """
+    对一个规模执行冷启动, 无修改, 修改单篇文章三种构建
+    :return: 结果列表
+    """
+    make_site(root, posts, seed=seed, resize=resize)
+    results = []
+    for scenario in ('cold', 'warm', 'edit'):
+        if scenario == 'edit':
+            edit_post(root, seed)
+        result = run_build(root, jobs)
+        result.update(scenario=scenario,
+                      posts=posts,
+                      jobs=jobs,
+                      posts_per_sec=posts / result['seconds'] if result['seconds'] else None)
+        results.append(result)
+        click.echo("%7d posts  %-5s %8.3fs %10.1f posts/s  peak %.1f MB" % (
+            posts, scenario, result['seconds'], result['posts_per_sec'] or 0,
+            (result['peak_rss'] or 0) / 1048576.0))
+    return results
+
+
+def benchmark(sizes, jobs=1, seed=0, work_dir=None, keep=False, resize=False):
+    """
+    :param sizes: 文章数列表
+    :param resize: 同时测量衍生图生成
+    :return: 可序列化为json的报告
+    """
+    base = work_dir or tempfile.mkdtemp(prefix='bibi-bench-')
+    results = []
+    try:
+        for posts in sizes:
+            results.extend(run_benchmark(os.path.join(base, 'site-%s' % posts), posts, jobs, seed, resize))
+    finally:
+        if not keep:
+            shutil.rmtree(base, ignore_errors=True)
+    return dict(created=datetime.datetime.now().isoformat(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpus=multiprocessing.cpu_count(),
+                seed=seed,
+                resize=resize,
+                results=results)
@@ -4,19 +4,49 @@ import re
 
 __author__ = 'liming'
 
+import io
 import os
 import sys
+import time
+import gzip
+import json
+import hashlib
 import datetime
 import shutil
-import markdown
+import sqlite3
+import fnmatch
+import tarfile
+import threading
+import traceback
+import unicodedata
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
 import yaml
 import click
 
-from six import iteritems
+from six import iteritems, text_type
 from jinja2.loaders import FunctionLoader
-from jinja2 import Environment, nodes
+from jinja2 import Environment, FileSystemBytecodeCache, nodes, meta, contextfilter
+from jinja2.exceptions import TemplateSyntaxError
 from jinja2.ext import Extension
 
+from .content import CONTENT_RENDERERS, CONTENT_VERSION, has_template_syntax, plain_text
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 SITE_FOLDER = '_site'
@@ -27,6 +57,44 @@ ASSETS_FOLDER = '_assets'
 MARKDOWN_FILES = ['md', 'markdown']
 HTML_FILES = ['html', 'htm']
 CONFIG = '_config.yaml'
+STATE_FOLDER = '.bibi'
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 8
+INDEX_FILE = 'index.sqlite'
+FICLONE = 0x40049409
+PRECOMPRESS_EXTS = ['html', 'htm', 'css', 'js', 'xml', 'svg', 'txt', 'json']
+PRECOMPRESS_MIN_SIZE = 1024
+COMPRESSED_EXTS = ['gz', 'br']
+FINGERPRINT_EXTS = ['css', 'js', 'png', 'jpg', 'jpeg', 'gif', 'svg', 'webp', 'ico',
+                    'woff', 'woff2', 'ttf', 'eot', 'otf']
+FINGERPRINT_LENGTH = 10
+ASSET_MANIFEST = 'asset-manifest.json'
+PROFILE_FILE = 'profile.json'
+DELTA_FILE = 'delta.json'
+# 写入部署包的增量清单, 部署端据此删除文件
+BUNDLE_DELTA = '.bibi-delta.json'
+STREAM_TEMPLATE_CACHE = 400
+CHAIN_PREFIX = '__chain__:'
+# 清单中搜索索引输出对应的条目名
+SEARCH_ENTRY = '__search__'
+# 清单中衍生图输出对应的条目名
+IMAGES_ENTRY = '__images__'
+# 含有继承语法的layout无法合并, 仍逐层渲染
+INHERITANCE_RE = re.compile(r'{%-?\s*(extends|block)\b')
+CACHE_FOLDER = 'cache'
+MARKDOWN_CACHE_SIZE = 256  # MB
+FRAGMENT_CACHE_SIZE = 64  # MB
+
+# 模板中引用这些变量或site的这些属性时, 输出依赖于全部文章的集合
+COLLECTION_NAMES = frozenset(['paginator', 'archive'])
+COLLECTION_ATTRS = frozenset(['posts', 'tags', 'archives', 'pages', 'index'])
+CONTENT_ATTRS = frozenset(['content', 'headings'])
+IMAGE_FILTERS = frozenset(['srcset', 'thumbnail'])
+# 归档分类用作文件名时只保留ascii字母, 数字, 下划线和连字符
+SLUG_RE = re.compile(r'[^A-Za-z0-9_-]+')
+
+# fork出的工作进程通过此变量访问父进程中的生成器
+_worker_generator = None
 
 
 
@@ -52,6 +120,53 @@ class FragmentGistExtension(Extension):
         node.data = '<script src="https://gist.github.com/%s.js"></script>' % gist_id
         return node
 
+
+class FragmentCacheExtension(Extension):
+    """
+    缓存模板片段: {% cache "名称"[, 变量...][ persist] %}...{% endcache %}
+    一次构建中名称, 变量和内容相同的片段只渲染一次; persist时保存到磁盘,
+    模板, 配置或文章集合变化后失效
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_memo={},
+                           fragment_store=None,
+                           fragment_inputs=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        persist = bool(parser.stream.skip_if('name:persist'))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        # 片段读取文章正文或引用其他模板时, 持久缓存还需随正文变化失效
+        full = any(node.attr == 'content' for item in body for node in item.find_all(nodes.Getattr)) or \
+            any(True for item in body for _ in item.find_all((nodes.Include, nodes.Import, nodes.FromImport)))
+        call_args = [nodes.Const(content_hash(repr(body))), nodes.Const(persist),
+                     nodes.Const(full), nodes.List(args)]
+        return nodes.CallBlock(self.call_method('_cache', call_args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, body_hash, persist, full, keys, caller):
+        env = self.environment
+        key = content_hash(body_hash, digest_object(keys))
+        if key in env.fragment_memo:
+            return env.fragment_memo[key]
+        store = env.fragment_store if persist and env.fragment_inputs else None
+        if store is not None:
+            store_key = content_hash(key, env.fragment_inputs[1 if full else 0])
+            html = store.get(store_key)
+            if html is None:
+                html = caller()
+                store.set(store_key, html)
+        else:
+            html = caller()
+        env.fragment_memo[key] = html
+        return html
+
+
 def date_to_string(date):
     """
     格式化日期的过滤器
@@ -83,19 +198,91 @@ def sorts(iterer, property, direction):
     :return:
     :rtype:
     """
+    if isinstance(iterer, PostList) and iterer.index is not None:
+        return iterer.index.sort(iterer, property, direction == 'desc')
     if direction == 'desc':
         return sorted(iterer, key=lambda item: item.meta[property], reverse=True)
     return sorted(iterer, key=lambda item: item.meta[property])
 
 
+def parse_query(query_string):
+    """
+    解析 key=value&key=value 形式的查询
+    :return: [(key, value)]
+    """
+    query_dt = dict([sq.split('=') for sq in query_string.split('&')])
+    return [(key.strip(), value.strip()) for key, value in iteritems(query_dt)]
+
+
 def query_list(iterer, query_string):
+    if isinstance(iterer, PostList) and iterer.index is not None:
+        return iterer.index.query(iterer, parse_query(query_string))
     q_list = iterer
-    query_dt = dict([sq.split('=') for sq in query_string.split('&')])
-    for key, value in iteritems(query_dt):
-        q_list = [item for item in q_list if item.meta.get(key.strip(), '') == value.strip()]
+    for key, value in parse_query(query_string):
+        q_list = [item for item in q_list if item.meta.get(key, '') == value]
     return q_list
 
 
+def build_selector(only=(), query=None, since=None, until=None):
+    """
+    部分生成时选择页面的条件, 各条件同时满足时选中
+    :param only: 源文件路径或文件名的通配符, 如 _post/2015-* 或 about.html
+    :param query: key=value&key=value 形式的头部查询, 只选择文章
+    :param since: 最早的文章日期(含)
+    :param until: 最晚的文章日期(含)
+    :return: 参数为页面上下文的函数
+    """
+    conditions = parse_query(query) if query else []
+
+    def select(context):
+        page, post = context['page'], context['post']
+        if only:
+            source = os.path.join(POSTS_FOLDER, page.key) if post is not None else page.key
+            if not any(fnmatch.fnmatch(source, pattern) or fnmatch.fnmatch(page.key, pattern)
+                       for pattern in only):
+                return False
+        if conditions or since or until:
+            if post is None:
+                return False
+            if any(text_type(post.meta.get(key, '')) != value for key, value in conditions):
+                return False
+            if since and post.date < since:
+                return False
+            if until and post.date > until:
+                return False
+        return True
+    return select
+
+
+def slugify_category(category):
+    """
+    归档分类对应的文件名部分, 可直接用于url; 去掉重音符号后没有可用字符时使用分类的哈希
+    """
+    text = text_type(category).strip()
+    ascii_text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    return SLUG_RE.sub(u'-', ascii_text).strip(u'-') or content_hash(text)[:8]
+
+
+def template_usage(ast):
+    """
+    从模板语法树中找出影响输出依赖的引用, 模板中的普通文字不计入
+    :return: dict(collection=文章集合, content=文章正文, assets=资源url, related=相关文章, images=衍生图)
+    """
+    names = set(node.name for node in ast.find_all(nodes.Name))
+    filters = set(node.name for node in ast.find_all(nodes.Filter))
+    attrs = set()
+    site_attrs = set()
+    for node in ast.find_all(nodes.Getattr):
+        attrs.add(node.attr)
+        if isinstance(node.node, nodes.Name) and node.node.name == 'site':
+            site_attrs.add(node.attr)
+    return dict(collection=bool(names & COLLECTION_NAMES or site_attrs & COLLECTION_ATTRS),
+                content=bool(attrs & CONTENT_ATTRS),
+                assets='asset' in names or 'asset' in filters,
+                related='related' in attrs,
+                images=bool(filters & IMAGE_FILTERS))
+
+
 def disqus(short_name):
     return """<div id="disqus_thread"></div>
     <script type="text/javascript">
@@ -113,6 +300,702 @@ def disqus(short_name):
     <a href="http://disqus.com" class="dsq-brlink">comments powered by <span class="logo-disqus">Disqus</span></a>
 """ % short_name
 
+def content_hash(*parts):
+    """
+    计算内容哈希
+    :param parts: 字符串或字节序列
+    :return: 十六进制sha1
+    """
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, text_type):
+            part = part.encode('utf-8')
+        sha.update(part)
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def digest_object(obj):
+    """
+    对可序列化对象计算稳定的哈希
+    """
+    return content_hash(json.dumps(obj, sort_keys=True, default=text_type))
+
+
+class BuildError(Exception):
+    """
+    生成某个源文件时出错
+    """
+    def __init__(self, source, message):
+        super(BuildError, self).__init__(source, message)
+        self.source = source
+        self.message = message
+
+    def __str__(self):
+        return "%s: %s" % (self.source, self.message)
+
+
+def _run_task(generator, method, source, item):
+    """
+    执行生成器方法, 出错时报告对应的源文件
+    """
+    try:
+        return getattr(generator, method)(item)
+    except BuildError:
+        raise
+    except Exception:
+        raise BuildError(source, traceback.format_exc())
+
+
+def _pool_init(generator):
+    """
+    工作进程初始化, 丢弃fork时从父进程带来的性能数据
+    """
+    global _worker_generator
+    _worker_generator = generator
+    generator.profiler.pop()
+
+
+def _pool_task(task):
+    """
+    工作进程入口
+    :param task: (方法名, 源文件名, 参数)
+    :return: (结果, 工作进程中记录的性能数据)
+    """
+    method, source, item = task
+    result = _run_task(_worker_generator, method, source, item)
+    return result, _worker_generator.profiler.pop()
+
+
+def peak_rss(who=None):
+    """
+    进程的内存峰值(字节), 不支持时返回None
+    :param who: resource.RUSAGE_SELF 或 resource.RUSAGE_CHILDREN
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    # linux下ru_maxrss单位是KB, mac下是字节
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class _NullPhase(object):
+    """
+    未开启性能分析时使用的空计时器
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    """
+    记录一个阶段的耗时和内存分配
+    """
+    def __init__(self, profiler, name, item):
+        self.profiler = profiler
+        self.name = name
+        self.item = item
+
+    def __enter__(self):
+        self.alloc = tracemalloc.get_traced_memory()[0] if self.profiler.tracing else None
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = default_timer() - self.start
+        alloc = tracemalloc.get_traced_memory()[0] - self.alloc if self.profiler.tracing else None
+        self.profiler.record(self.name, self.item, seconds, alloc)
+        return False
+
+
+class BuildProfiler(object):
+    """
+    记录构建各阶段和各文件的耗时与内存分配, 阶段可以嵌套, 耗时包含子阶段
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.tracing = False
+        self.phases = {}
+        self.items = {}
+        self.started = default_timer()
+        if enabled and tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.tracing = True
+
+    def phase(self, name, item=None):
+        """
+        :param name: 阶段名
+        :param item: 文件名或模板名, 用于统计最慢的文件
+        """
+        if not self.enabled:
+            return NULL_PHASE
+        return _Phase(self, name, item)
+
+    def record(self, name, item, seconds, alloc=None):
+        """
+        :param alloc: 分配的字节数, 没有tracemalloc(Python 2)时为None, 不记录
+        """
+        stat = self.phases.setdefault(name, dict(count=0, seconds=0.0))
+        stat['count'] += 1
+        stat['seconds'] += seconds
+        if alloc is not None:
+            stat['alloc'] = stat.get('alloc', 0) + alloc
+        if item is not None:
+            items = self.items.setdefault(name, {})
+            items[item] = items.get(item, 0.0) + seconds
+
+    def pop(self):
+        """
+        取出并清空已记录的数据, 用于把工作进程的数据带回父进程
+        """
+        if not self.enabled:
+            return None
+        data = (self.phases, self.items)
+        self.phases, self.items = {}, {}
+        return data
+
+    def merge(self, data):
+        if not data:
+            return
+        phases, items = data
+        for name, stat in iteritems(phases):
+            target = self.phases.setdefault(name, dict(count=0, seconds=0.0))
+            for key, value in iteritems(stat):
+                target[key] = target.get(key, 0) + value
+        for name, values in iteritems(items):
+            target = self.items.setdefault(name, {})
+            for item, seconds in iteritems(values):
+                target[item] = target.get(item, 0.0) + seconds
+
+    def report(self, top=10):
+        """
+        :param top: 每个阶段列出最慢的文件数
+        :return: 可序列化为json的报告
+        """
+        report = dict(created=datetime.datetime.now().isoformat(),
+                      total_seconds=default_timer() - self.started,
+                      phases=self.phases,
+                      slowest=dict((name, sorted(iteritems(values), key=lambda kv: kv[1], reverse=True)[:top])
+                                   for name, values in iteritems(self.items)))
+        if resource is not None:
+            report['peak_rss'] = peak_rss()
+            report['peak_rss_children'] = peak_rss(resource.RUSAGE_CHILDREN)
+        if self.tracing:
+            report['peak_traced'] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def summary(self, report):
+        """
+        :return: 便于阅读的文本
+        """
+        tracing = 'peak_traced' in report
+        lines = ["%-14s %8s %10s" % ('phase', 'count', 'seconds') + (" %12s" % 'alloc' if tracing else '')]
+        for name, stat in sorted(iteritems(report['phases']), key=lambda kv: kv[1]['seconds'], reverse=True):
+            lines.append("%-14s %8d %10.3f" % (name, stat['count'], stat['seconds']) +
+                         (" %12d" % stat.get('alloc', 0) if tracing else ''))
+        for name in ('markdown', 'page', 'render'):
+            if report['slowest'].get(name):
+                lines.append("slowest %s:" % name)
+                for item, seconds in report['slowest'][name]:
+                    lines.append("  %10.3f  %s" % (seconds, item))
+        lines.append("total %.3fs" % report['total_seconds'])
+        if 'peak_rss' in report:
+            lines.append("peak RSS %.1f MB (workers %.1f MB)" % (report['peak_rss'] / 1048576.0,
+                                                                report['peak_rss_children'] / 1048576.0))
+        if not tracing:
+            lines.append("allocations unavailable (tracemalloc needs Python 3.4+)")
+        return "\n".join(lines)
+
+
+def replace_file(src_path, dst_path):
+    """
+    用src_path原子替换dst_path, windows下rename不能覆盖已有文件
+    """
+    if os.name == 'nt' and os.path.exists(dst_path):
+        os.remove(dst_path)
+    os.rename(src_path, dst_path)
+
+
+def write_if_changed(path, data):
+    """
+    已有文件内容相同时跳过, 否则写入临时文件后原子替换, 避免留下写了一半的文件
+    :return: 是否写入
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                    return False
+    except (IOError, OSError):
+        pass
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        replace_file(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def write_json(path, obj):
+    """
+    以json原子写入, 目录不存在时创建, 内容相同时跳过
+    :return: 是否写入
+    """
+    dir_path = os.path.dirname(path)
+    if not os.path.exists(dir_path):
+        try:
+            os.makedirs(dir_path)
+        except OSError:
+            # 并行的工作进程可能同时创建
+            pass
+    return write_if_changed(path, json.dumps(obj).encode('utf-8'))
+
+
+def file_digest(path):
+    """
+    分块计算文件的sha1
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_stat(path):
+    """
+    :return: (mtime, 大小)
+    """
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def output_delta(previous, current):
+    """
+    比较两次构建的输出文件
+    :param previous: 上次构建的{路径: [mtime, 大小, sha1]}, 上次没有计算哈希时sha1为None
+    :param current: 本次构建的{路径: [mtime, 大小, sha1]}
+    :return: 新增, 修改, 删除的路径及哈希
+    """
+    added = {}
+    changed = {}
+    for path, record in iteritems(current):
+        if path not in previous:
+            added[path] = record[2]
+        elif previous[path][2] is None:
+            # 上次没有哈希, 只能按mtime和大小判断
+            if previous[path][:2] != record[:2]:
+                changed[path] = record[2]
+        elif previous[path][2] != record[2]:
+            changed[path] = record[2]
+    deleted = sorted(path for path in previous if path not in current)
+    return dict(added=added, changed=changed, deleted=deleted)
+
+
+def write_bundle(fileobj, site_root, delta, mode='w|'):
+    """
+    把增量中新增和修改的文件以流的方式写入tar包, 增量清单作为第一个成员
+    :param fileobj: 可写的文件对象
+    :param site_root: 输出目录
+    :param delta: output_delta的结果
+    :return: 写入的文件数和字节数
+    """
+    data = json.dumps(delta, indent=2, sort_keys=True).encode('utf-8')
+    count = size = 0
+    tar = tarfile.open(fileobj=fileobj, mode=mode)
+    try:
+        info = tarfile.TarInfo(BUNDLE_DELTA)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+        files = dict(delta['added'])
+        files.update(delta['changed'])
+        for path in sorted(files):
+            file_path = os.path.join(site_root, path)
+            if not os.path.isfile(file_path) or file_digest(file_path) != files[path]:
+                raise click.ClickException("%s changed since the last build, run gen --delta again" % path)
+            tar.add(file_path, arcname=path.replace(os.sep, '/'), recursive=False)
+            count += 1
+            size += os.path.getsize(file_path)
+    finally:
+        tar.close()
+    return count, size
+
+
+def asset_unchanged(src_path, dst_path, use_hash=False):
+    """
+    判断输出目录中的资源是否与源文件一致: 大小和mtime相同, 或者开启use_hash时内容哈希相同
+    """
+    try:
+        src_stat = os.stat(src_path)
+        dst_stat = os.stat(dst_path)
+    except OSError:
+        return False
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if use_hash:
+        if file_digest(src_path) != file_digest(dst_path):
+            return False
+        if int(src_stat.st_mtime) != int(dst_stat.st_mtime):
+            # 内容一致只是mtime不同, 同步mtime后下次无需再比较内容
+            shutil.copystat(src_path, dst_path)
+        return True
+    return int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def link_or_copy(src_path, dst_path, mode='copy'):
+    """
+    按mode以硬链接, reflink或复制的方式输出资源, 链接失败时退回到复制
+    """
+    if os.path.lexists(dst_path):
+        # 先删除, 避免通过已有的硬链接改写源文件
+        os.remove(dst_path)
+    if mode == 'hardlink':
+        try:
+            os.link(src_path, dst_path)
+            return
+        except (OSError, AttributeError):
+            pass
+    elif mode == 'reflink':
+        try:
+            import fcntl
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(src_path, dst_path)
+            return
+        except (IOError, OSError, ImportError):
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+    shutil.copy2(src_path, dst_path)
+
+
+def gzip_bytes(data):
+    """
+    gzip压缩, 固定mtime, 内容相同时压缩结果也相同
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+def compress_file(task):
+    """
+    为文件写入预压缩的同名.gz/.br文件
+    :param task: (文件路径, [压缩格式])
+    """
+    path, encodings = task
+    with open(path, 'rb') as f:
+        data = f.read()
+    for encoding in encodings:
+        if encoding == 'gz':
+            compressed = gzip_bytes(data)
+        else:
+            compressed = brotli.compress(data)
+        target_path = "%s.%s" % (path, encoding)
+        tmp_path = "%s.%s.tmp" % (target_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        replace_file(tmp_path, target_path)
+    return path
+
+
+class BuildManifest(object):
+    """
+    构建清单, 记录源文件哈希以及每个源文件的输出和依赖哈希
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        self.entries = {}
+        self.refs = {}
+        self.assets = []
+        self.files = {}
+        # 上次保存后清单文件的mtime和大小, 文件未被其他进程修改时无需重新读取
+        self.saved = None
+
+    def load(self):
+        """
+        读取上次构建的清单, 版本不一致时视为没有清单
+        :return: 是否成功读取
+        """
+        if not os.path.exists(self.path):
+            return False
+        saved, self.saved = self.saved, None
+        if saved is not None and saved == file_stat(self.path):
+            return True
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return False
+        if data.get('version') != MANIFEST_VERSION:
+            return False
+        self.sources = data.get('sources', {})
+        self.entries = data.get('entries', {})
+        self.refs = data.get('refs', {})
+        self.assets = data.get('assets', [])
+        self.files = data.get('files', {})
+        return True
+
+    def save(self):
+        write_json(self.path, dict(version=MANIFEST_VERSION,
+                                   sources=self.sources,
+                                   entries=self.entries,
+                                   refs=self.refs,
+                                   assets=self.assets,
+                                   files=self.files))
+        self.saved = file_stat(self.path)
+
+    def outputs(self):
+        """
+        清单中记录的全部输出路径
+        """
+        paths = set()
+        for entry in self.entries.values():
+            paths.update(entry.get('outputs', []))
+        return paths
+
+
+class MarkdownCache(object):
+    """
+    文章渲染结果的磁盘缓存, 按内容哈希寻址, 超出容量时淘汰最久未使用的条目
+    """
+    def __init__(self, path, max_size, salt):
+        """
+        :param path: 缓存目录
+        :param max_size: 最大字节数
+        :param salt: 渲染器版本和配置, 变化时全部缓存失效
+        """
+        self.path = path
+        self.max_size = max_size
+        self.salt = salt
+
+    def _entry_path(self, raw_content):
+        key = content_hash(self.salt, raw_content)
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, raw_content):
+        """
+        :return: (html内容, 首图, 摘要, 标题, 图片列表), 未命中返回None
+        """
+        entry_path = self._entry_path(raw_content)
+        try:
+            with open(entry_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        # 更新mtime作为最近使用时间
+        os.utime(entry_path, None)
+        return data['content'], data['page_image'], data['description'], data['headings'], data['images']
+
+    def set(self, raw_content, value):
+        content, page_image, description, headings, images = value
+        write_json(self._entry_path(raw_content), dict(content=content, page_image=page_image,
+                                                       description=description, headings=headings,
+                                                       images=images))
+
+    def evict(self):
+        """
+        缓存超出容量时删除最久未使用的条目
+        """
+        if not os.path.exists(self.path):
+            return
+        entries = []
+        total = 0
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                entry_path = os.path.join(dir_path, file_name)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, entry_path in entries:
+            os.remove(entry_path)
+            total -= size
+            if total <= self.max_size:
+                break
+
+
+class FragmentCache(MarkdownCache):
+    """
+    模板片段的磁盘缓存, 按片段和输入的哈希寻址
+    """
+    def get(self, key):
+        """
+        :return: 片段html, 未命中返回None
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as f:
+                html = f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+        os.utime(entry_path, None)
+        return html
+
+    def set(self, key, html):
+        entry_path = self._entry_path(key)
+        dir_path = os.path.dirname(entry_path)
+        if not os.path.exists(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                pass
+        write_if_changed(entry_path, text_type(html).encode('utf-8'))
+
+
+class SourceIndex(object):
+    """
+    源文件元数据索引, 按路径记录mtime, 大小, 哈希和头部数据,
+    启动时mtime和大小未变的文件无需再读取; 另按内容记录文章摘要, 未变化的文章无需读取正文
+    """
+    def __init__(self, path):
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sources ('
+                          'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, header TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS assets ('
+                          'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT)')
+        self.seen = set()
+        # 常驻的生成器反复构建时, 已读取的摘要留在内存中
+        self.summaries = {}
+
+    def get(self, path, mtime, size):
+        """
+        :return: (哈希, 头部字典), 文件有变化时返回None
+        """
+        self.seen.add(path)
+        row = self.conn.execute('SELECT mtime, size, hash, header FROM sources WHERE path=?',
+                                (path,)).fetchone()
+        if row and row[0] == mtime and row[1] == size:
+            return row[2], json.loads(row[3])
+        return None
+
+    def put(self, path, mtime, size, digest, header):
+        self.seen.add(path)
+        self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)',
+                          (path, mtime, size, digest, json.dumps(header)))
+
+    def discard(self, path):
+        self.conn.execute('DELETE FROM sources WHERE path=?', (path,))
+
+    def commit(self, prune=True):
+        """
+        删除本次没有出现的源文件并提交
+        :param prune: 只重新读取了部分源文件时为False, 不删除其他记录
+        """
+        if prune:
+            for (path,) in self.conn.execute('SELECT path FROM sources').fetchall():
+                if path not in self.seen:
+                    self.conn.execute('DELETE FROM sources WHERE path=?', (path,))
+        self.conn.commit()
+        self.seen = set()
+
+    def asset_digest(self, path, mtime, size):
+        """
+        资源文件的sha1, mtime和大小未变时使用记录的哈希
+        """
+        row = self.conn.execute('SELECT mtime, size, hash FROM assets WHERE path=?', (path,)).fetchone()
+        if row and row[0] == mtime and row[1] == size:
+            return row[2]
+        digest = file_digest(path)
+        self.conn.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?)', (path, mtime, size, digest))
+        return digest
+
+    def commit_assets(self, paths):
+        """
+        删除不在paths中的资源记录并提交
+        """
+        paths = set(paths)
+        for (path,) in self.conn.execute('SELECT path FROM assets').fetchall():
+            if path not in paths:
+                self.conn.execute('DELETE FROM assets WHERE path=?', (path,))
+        self.conn.commit()
+
+    def summary(self, key):
+        """
+        :return: [首图, 摘要, 标题, 图片列表], 没有记录时返回None
+        """
+        if key not in self.summaries:
+            row = self.conn.execute('SELECT summary FROM summaries WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.summaries[key] = json.loads(row[0])
+        return self.summaries[key]
+
+    def put_summary(self, key, summary):
+        self.summaries[key] = list(summary)
+        self.conn.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?)', (key, json.dumps(list(summary))))
+
+    def commit_summaries(self, keys=None):
+        """
+        删除不在keys中的摘要并提交, keys为None时只提交
+        """
+        if keys is not None:
+            keys = set(keys)
+            for (key,) in self.conn.execute('SELECT key FROM summaries').fetchall():
+                if key not in keys:
+                    self.conn.execute('DELETE FROM summaries WHERE key=?', (key,))
+            self.summaries = dict((key, summary) for key, summary in iteritems(self.summaries) if key in keys)
+        self.conn.commit()
+
+
+class TemplateSource(object):
+    """
+    按需读取模板正文; layout和include读取后常驻内存, 文章正文每次使用时读取
+    """
+    def __init__(self, process_header):
+        self.process_header = process_header
+        self.paths = {}
+        self.bodies = {}
+        self.retain = set()
+
+    def add(self, name, path, body=None, retain=True):
+        self.paths[name] = path
+        if retain:
+            self.retain.add(name)
+            if body is not None:
+                self.bodies[name] = body
+
+    def remove(self, name):
+        self.paths.pop(name, None)
+        self.bodies.pop(name, None)
+        self.retain.discard(name)
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __getitem__(self, name):
+        if name in self.bodies:
+            return self.bodies[name]
+        with open(self.paths[name], 'r') as f:
+            body = self.process_header(f.read())[1].decode('utf-8')
+        if name in self.retain:
+            self.bodies[name] = body
+        return body
+
+    def get(self, name, default=None):
+        if name not in self.paths:
+            return default
+        return self[name]
+
+
 class Page(object):
     """
     page对象
@@ -123,43 +1006,75 @@ class Page(object):
     directory = None
     title = None
     date = None
-    template_str = None
-    template_instance = None
+    template_source = None
+    environment = None
     page_size = None
     page_filter = None
     page_sort = None
     page_image = None
+    archive = None
     is_post = None
 
+    @property
+    def template_str(self):
+        """
+        模板源码, 使用时才读取
+        """
+        if self.template_source is None:
+            return None
+        return self.template_source.get(self.key)
+
+    @property
+    def template_instance(self):
+        """
+        编译后的模板, 使用时才编译
+        """
+        if self.environment is None:
+            return None
+        return self.environment.get_template(self.key)
+
 
 class Post(object):
     """
-    post对象
+    post对象, 使用__slots__以减少大量文章时的内存占用;
+    设置loader时正文使用时才加载, 流式生成时不常驻内存, 每次读取时重新加载
     """
-    url = None
-    title = None
-    content = None
-    date = None
-    author = None
-    tags = None
-    meta = None
-    description = None
+    __slots__ = ('url', 'title', '_content', 'date', 'author', 'tags', 'meta', 'description',
+                 'page_image', 'source', 'loader', 'related', 'headings')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    @property
+    def content(self):
+        if self._content is None and self.loader is not None:
+            return self.loader(self)
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
 
 class Archive(object):
     """
     归档器对象
     """
-    posts =[]
+    kind = None
     category = None
+    slug = None
+    tag = None
     year = 0
     month = 0
 
+    def __init__(self):
+        self.posts = []
+
 
 class Paginator(object):
     """
     分页器对象
     """
-    posts = []
     page = None
     per_page = None
     total_posts = None
@@ -169,49 +1084,242 @@ class Paginator(object):
     next_page = None
     next_page_path = None
 
+    def __init__(self):
+        self.posts = []
+
+
+class PostList(list):
+    """
+    文章列表, 记录所属的站点索引以及相对于全部文章的查询条件
+    """
+    def __init__(self, items=(), index=None, view=None):
+        super(PostList, self).__init__(items)
+        self.index = index
+        self.view = view or (frozenset(), ())
+
+
+class SiteIndex(object):
+    """
+    站点文章索引, 每次构建建立一次.
+    按标签, 作者, 年月分组; 按front matter属性分组和排序结果在第一次使用时建立,
+    相同的(查询, 排序)组合只计算一次
+    """
+    def __init__(self, posts):
+        """
+        :param posts: 已排序的全部文章
+        """
+        self.posts = PostList(posts, self)
+        self.tags = {}
+        self.authors = {}
+        self.months = {}
+        self.years = {}
+        for post in posts:
+            for tag in post.tags:
+                self.tags.setdefault(tag, []).append(post)
+            self.authors.setdefault(post.author, []).append(post)
+            key = "%s-%s" % (post.date.year, post.date.month)
+            self.months.setdefault(key, []).append(post)
+            self.years.setdefault(post.date.year, []).append(post)
+        self._meta = {}
+        self._slugs = {}
+        self._views = {self.posts.view: self.posts}
+
+    def archives(self, kind):
+        """
+        归档分组
+        :param kind: month, year 或 tag
+        :return: [(分类, [post])], 年月和年份从新到旧, 标签按名称排序
+        """
+        if kind == 'year':
+            return [(year, self.years[year]) for year in sorted(self.years, reverse=True)]
+        if kind == 'tag':
+            return [(tag, self.tags[tag]) for tag in sorted(self.tags) if tag.strip()]
+        return [(key, self.months[key]) for key in sorted(self.months, reverse=True)]
+
+    def slug(self, kind, category):
+        """
+        归档分类的文件名部分. 不同分类得到相同结果(不区分大小写)时, 与结果完全相同的小写分类
+        保留原名, 其他分类加上自身的短哈希, 不随其他分类的增减变化
+        """
+        if kind not in self._slugs:
+            groups = {}
+            for name, _ in self.archives(kind):
+                groups.setdefault(slugify_category(name).lower(), []).append(name)
+            slugs = {}
+            for names in groups.values():
+                for name in names:
+                    slug = slugify_category(name)
+                    if len(names) > 1 and text_type(name).strip() != slug.lower():
+                        slug = u'%s-%s' % (slug, content_hash(text_type(name).strip())[:8])
+                    slugs[name] = slug
+            self._slugs[kind] = slugs
+        return self._slugs[kind].get(category) or slugify_category(category)
+
+    def by_meta(self, key):
+        """
+        按front matter属性值分组
+        :return: {属性值: [post]}
+        """
+        if key not in self._meta:
+            groups = {}
+            for post in self.posts:
+                groups.setdefault(post.meta.get(key, ''), []).append(post)
+            self._meta[key] = groups
+        return self._meta[key]
+
+    def select(self, filters=(), sorts=()):
+        """
+        按条件筛选并排序全部文章, 结果在本次构建内缓存
+        :param filters: [(key, value)] 需全部满足
+        :param sorts: [(key, reverse)] 依次进行的稳定排序
+        """
+        view = (frozenset(filters), tuple(sorts))
+        if view not in self._views:
+            filters, sorts = view
+            if filters:
+                # 从最小的分组开始求交集, 保持文章原有顺序
+                groups = sorted((self.by_meta(key).get(value, []) for key, value in filters), key=len)
+                items = groups[0]
+                for group in groups[1:]:
+                    ids = set(id(post) for post in group)
+                    items = [post for post in items if id(post) in ids]
+            else:
+                items = self.posts
+            for key, reverse in sorts:
+                items = sorted(items, key=lambda item: item.meta[key], reverse=reverse)
+            self._views[view] = PostList(items, self, view)
+        return self._views[view]
+
+    def query(self, posts, filters):
+        filters_base, sorts = posts.view
+        return self.select(filters_base | frozenset(filters), sorts)
+
+    def sort(self, posts, key, reverse):
+        filters, sorts = posts.view
+        return self.select(filters, sorts + ((key, reverse),))
+
+
 class Site(object):
     """
     站点对象
     """
-    pages = []
-    posts = []
-    tags = []
-    archives = []
-    config = {}
+    index = None
     paginate = 10
 
+    def __init__(self):
+        self.pages = []
+        self.posts = []
+        self.tags = []
+        self.archives = []
+        self.config = {}
+
 
 class Generator(object):
     """
-    页面生成器
+    页面生成器. 所有路径都相对于root和output, 状态都保存在实例中,
+    同一实例可反复构建并复用已编译的模板和缓存, 不同实例可在多个线程中同时构建
     """
-    def __init__(self):
+    def __init__(self, jobs=1, profile=False, stream=False, root=None, output=None, echo=None, delta=False):
+        """
+        :param root: 站点源文件目录, 默认为当前目录
+        :param output: 输出目录, 默认为root下的_site
+        :param echo: 输出信息的函数, 默认为click.echo
+        :param delta: 计算输出文件的哈希并记录与上次构建的增量, 否则只记录mtime和大小
+        """
+        self.root = os.path.abspath(root or os.getcwd())
+        self.output_root = os.path.abspath(output or os.path.join(self.root, SITE_FOLDER))
+        self.echo = echo or click.echo
+        self.lock = threading.RLock()
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.stream = stream
+        self.profiler = BuildProfiler(profile)
+        self.manifest = BuildManifest(os.path.join(self.root, STATE_FOLDER, MANIFEST_FILE))
+        self.full_build = True
+        self.outputs = []
+        self.written = 0
+        self.stats = {}
+        self.record_delta = delta
+        self.delta = None
+        self.asset_urls = {}
+        self.assets_digest = ''
+        self.asset_digests = {}
+        self.image_urls = {}
+        self.images_digest = ''
+        self.source_hashes = {}
+        self.templates = None
+        self._related_index = None
+        self._layer = None
+        self._post_digests = {}
+        self.env = None
+        self.index = SourceIndex(os.path.join(self.root, STATE_FOLDER, INDEX_FILE))
+        self.load()
+        self.config_env()
+        self._loaded = True
+
+    def build(self, full=False, select=None, listings=False, changed=None):
+        """
+        重新读取源文件并生成站点, 同一实例上的构建依次执行
+        :param changed: 变化的文件绝对路径, 给出时只重新读取这些源文件
+        :return: 生成统计
+        """
+        with self.lock:
+            if not self._loaded:
+                self.load(changed=changed)
+            self._loaded = False
+            self.parse_file(full=full, select=select, listings=listings)
+            return self.stats
+
+    def load(self, changed=None):
+        """
+        读取配置和全部源文件, 常驻的生成器可重复调用以刷新
+        :param changed: 变化的文件绝对路径, 给出时只重新读取其中的源文件, 其他源文件沿用上次的结果
+        :return: 是否有源文件变化
+        """
+        previous_hashes = dict(self.source_hashes)
         self.site = Site()
         self.site.pages = []
         self.site.posts = []
         self.site.tags = ()
-        self.templates = {}
-        self.context_propertys = {}
-        self.context_instances = {}
-        self.template_name_map = {}
-        self.includes = []
-        self._get_files(LAYOUTS_FOLDER, allow_ext=['.html', '.htm'])
-        self._get_files(INCLUDE_FOLDER, allow_ext=['.html', '.htm'])
-        self._get_files("", allow_ext=['.html', '.htm', '.xml', '.md', '.markdown'])
-        self._get_files(POSTS_FOLDER, allow_ext=['.md', '.markdown'])
-        self.paginator = Paginator()
-        self.archive = Archive()
-        self.open_archive = False
-        self.archives = []
+        if changed is None or self.templates is None:
+            self.templates = TemplateSource(self._process_header)
+            self.context_propertys = {}
+            self.context_instances = {}
+            self.template_name_map = {}
+            self.includes = []
+            self.source_hashes = {}
+            self.source_paths = {}
+            for folder, allow_ext in self._source_folders():
+                self._get_files(folder, allow_ext=allow_ext)
+            self.index.commit()
+        else:
+            with self.profiler.phase('scan', 'changed'):
+                self._rescan_files(changed)
+            self.index.commit(prune=False)
 
-        config_path = os.path.join(os.getcwd(), CONFIG)
+        self.config_hash = ''
+        config_path = os.path.join(self.root, CONFIG)
         if os.path.exists(config_path):
             with open(config_path, 'r') as f:
-                config = yaml.load(f.read())
+                config_content = f.read()
+                self.config_hash = content_hash(config_content)
+                config = yaml.load(config_content)
                 for k, v in iteritems(config):
                     setattr(self.site, k, v)
-        self.config_env()
-
+        self.renderers = dict((ext, renderer(self.site)) for ext, renderer in iteritems(CONTENT_RENDERERS))
+        self.markdown_cache = MarkdownCache(
+            os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'markdown'),
+            int(getattr(self.site, 'markdown_cache_size', MARKDOWN_CACHE_SIZE)) * 1024 * 1024,
+            digest_object([CONTENT_VERSION] + sorted([ext, renderer.salt]
+                                                     for ext, renderer in iteritems(self.renderers))))
+        self.fragment_cache = FragmentCache(
+            os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'fragments'),
+            int(getattr(self.site, 'fragment_cache_size', FRAGMENT_CACHE_SIZE)) * 1024 * 1024, '')
+
+        changed = previous_hashes != self.source_hashes
+        if changed and self.env is not None:
+            # 已编译的模板可能过期, 字节码缓存会按校验和重新使用未变化的模板
+            self.env.cache.clear()
+        return changed
 
     def load_template(self, name):
         """
@@ -219,28 +1327,119 @@ class Generator(object):
         :param name:模板文件名
         :return:
         """
+        if name.startswith(CHAIN_PREFIX):
+            return self._compose_chain(name[len(CHAIN_PREFIX):].split('>'))
         if name in self.templates:
             return self.templates.get(name)
         return ""
 
+    def _layout_chain(self, layout):
+        """
+        从layout开始沿头部的layout属性解析出的模板文件列表
+        """
+        chain = []
+        while layout and layout in self.template_name_map:
+            file_name = self.template_name_map.get(layout)
+            if file_name in chain:
+                break
+            chain.append(file_name)
+            ppt = self.context_propertys.get(file_name)
+            layout = ppt.get('layout') if ppt else None
+        return chain
+
+    def _compose_chain(self, chain):
+        """
+        把layout链合并成一个模板: 每一层渲染的结果作为下一层的content
+        """
+        sources = []
+        for file_name in chain:
+            source = self.templates.get(file_name) or u''
+            # 与单独渲染一致, 去掉每层末尾的一个换行
+            if source.endswith(u'\r\n'):
+                source = source[:-2]
+            elif source.endswith(u'\n'):
+                source = source[:-1]
+            if self.profiler.enabled:
+                # 每层开始时记录上一层的耗时, 合并后仍能按layout统计
+                source = u"{{ _bibi_layer(%s) }}%s" % (json.dumps(file_name), source)
+            sources.append(source)
+        if self.profiler.enabled:
+            sources[-1] += u"{{ _bibi_layer(none) }}"
+        composed = u"{%% set _bibi_layer_0 %%}%s{%% endset %%}" % sources[0]
+        for idx, source in enumerate(sources[1:-1], 1):
+            composed += u"{%% set _bibi_layer_%s %%}{%% with content = _bibi_layer_%s %%}%s{%% endwith %%}{%% endset %%}" % (
+                idx, idx - 1, source)
+        composed += u"{%% with content = _bibi_layer_%s %%}%s{%% endwith %%}" % (len(sources) - 2, sources[-1])
+        return composed
+
     def config_env(self):
         """
         设置模板环境
         :return:
         """
+        bytecode_path = os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'jinja')
+        if not os.path.exists(bytecode_path):
+            os.makedirs(bytecode_path)
+        # 模板在一次构建中不会变化, 每个模板只编译一次;
+        # 字节码按模板名缓存并以源码校验和验证, 模板修改后自动失效.
+        # 流式生成时只缓存最近使用的模板, 避免文章模板全部常驻内存
         self.env = Environment(
             loader=FunctionLoader(self.load_template),
             extensions=[
                 FragmentGistExtension,
+                FragmentCacheExtension,
             ],
-            auto_reload=True,
-            cache_size=0
+            auto_reload=False,
+            cache_size=STREAM_TEMPLATE_CACHE if self.stream else -1,
+            bytecode_cache=FileSystemBytecodeCache(bytecode_path)
         )
         self.env.filters['date_to_string'] = date_to_string
         self.env.filters['limit'] = limit
         self.env.filters['disqus'] = disqus
         self.env.filters['sort'] = sorts
         self.env.filters['query'] = query_list
+        # 资源url随构建变化, contextfilter不会在编译时被常量折叠进字节码缓存
+        self.env.filters['asset'] = contextfilter(lambda context, path: self.asset_url(path))
+        self.env.globals['asset'] = self.asset_url
+        self.env.globals['_bibi_layer'] = self._layer_mark
+        self.env.filters['srcset'] = contextfilter(lambda context, path, image_format=None:
+                                                   self.image_srcset(path, image_format))
+        self.env.filters['thumbnail'] = contextfilter(lambda context, path, image_format=None:
+                                                      self.image_thumbnail(path, image_format))
+
+    def asset_url(self, path):
+        """
+        资源的url, 开启asset_fingerprint时指向带内容哈希的文件
+        """
+        path = path.lstrip('/')
+        return '/' + self.asset_urls.get(path, path)
+
+    def _image_info(self, path):
+        return self.image_urls.get((path or '').split('?')[0].split('#')[0].lstrip('/'))
+
+    def image_srcset(self, path, image_format=None):
+        """
+        图片的srcset属性值, 从小到大列出衍生图, 原格式时最后是原图; 没有衍生图时为空
+        :param image_format: 默认与原图相同, 可为webp
+        """
+        info = self._image_info(path)
+        if not info:
+            return ''
+        image_format = image_format or info['format']
+        candidates = list(info['srcset'].get(image_format, []))
+        if image_format == info['format']:
+            candidates.append([info['width'], self.asset_url(path)])
+        return ', '.join('%s %sw' % (url, width) for width, url in candidates)
+
+    def image_thumbnail(self, path, image_format=None):
+        """
+        图片缩略图的url, 没有缩略图时返回原图
+        """
+        info = self._image_info(path)
+        if not info:
+            return self.asset_url(path) if path else ''
+        thumbnails = info['thumbnail']
+        return thumbnails.get(image_format or info['format']) or thumbnails[info['format']]
 
 
     def _process_header(self, file):
@@ -287,48 +1486,267 @@ class Generator(object):
         :param markdown:是否是markdown文件
         :return: [[file name, file data]]
         """
-        path = os.path.join(os.getcwd(), folder)
+        with self.profiler.phase('scan', folder or '.'):
+            self._scan_files(folder, allow_ext)
+
+    def _source_folders(self):
+        """
+        :return: [(源文件目录, 允许的扩展名)]
+        """
+        return [(LAYOUTS_FOLDER, ['.html', '.htm']),
+                (INCLUDE_FOLDER, ['.html', '.htm']),
+                ("", ['.html', '.htm', '.xml', '.md', '.markdown']),
+                (POSTS_FOLDER, ['.%s' % ext for ext in CONTENT_RENDERERS])]
+
+    def _scan_files(self, folder, allow_ext):
+        path = os.path.join(self.root, folder)
         if not os.path.exists(path):
-            click.echo("Not in project directory")
+            self.echo("Not in project directory")
         file_paths = os.listdir(path)
         for file_name in file_paths:
             if os.path.splitext(file_name)[1] not in allow_ext:
                 continue
-            file_path = os.path.join(path, file_name)
-            if os.path.exists(file_path):
-                dt = datetime.datetime.fromtimestamp(os.stat(file_path).st_mtime)
+            self._scan_file(folder, file_name)
+
+    def _scan_file(self, folder, file_name):
+        file_path = os.path.join(self.root, folder, file_name)
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            dt = datetime.datetime.fromtimestamp(stat.st_mtime)
+            source_path = os.path.join(folder, file_name)
+            cached = self.index.get(source_path, stat.st_mtime, stat.st_size)
+            if cached:
+                digest, propertys = cached
+                template_html = None
+            else:
                 with open(file_path, 'r') as f:
                     file_content = f.read()
+                with self.profiler.phase('header', file_name):
                     propertys, template_html = self._process_header(file_content)
-                    propertys.update(dict(date=dt))
-                    if folder==POSTS_FOLDER:
-                        propertys.update(dict(is_content=True))
-                    else:
-                        propertys.update(dict(is_content=False))
-                    if folder=='':
-                        propertys.update(dict(is_page=True))
-                    else:
-                        propertys.update(dict(is_page=False))
-                    self.templates[file_name] = template_html.decode('utf-8')
-                    self.template_name_map[os.path.splitext(file_name)[0]] = file_name
-                    self.context_propertys[file_name] = propertys
+                template_html = template_html.decode('utf-8')
+                digest = content_hash(file_content)
+                self.index.put(source_path, stat.st_mtime, stat.st_size, digest, propertys)
+            propertys.update(dict(date=dt))
+            if folder==POSTS_FOLDER:
+                propertys.update(dict(is_content=True))
+            else:
+                propertys.update(dict(is_content=False))
+            if folder=='':
+                propertys.update(dict(is_page=True))
+            else:
+                propertys.update(dict(is_page=False))
+            self.templates.add(file_name, file_path, template_html, retain=folder != POSTS_FOLDER)
+            self.source_hashes[file_name] = digest
+            self.source_paths[file_name] = source_path
+            self.template_name_map[os.path.splitext(file_name)[0]] = file_name
+            self.context_propertys[file_name] = propertys
 
-                    if folder == INCLUDE_FOLDER:
-                        self.includes.append(file_name)
+            if folder == INCLUDE_FOLDER:
+                self.includes.append(file_name)
 
+    def _rescan_files(self, changed):
+        """
+        重新读取变化的源文件, 删除已不存在的源文件; 其他目录的文件(如资源)在生成时同步
+        :param changed: 变化的文件绝对路径
+        """
+        folders = dict(self._source_folders())
+        for path in changed:
+            folder, file_name = os.path.split(os.path.relpath(path, self.root))
+            if folder not in folders or os.path.splitext(file_name)[1] not in folders[folder]:
+                continue
+            source_path = os.path.join(folder, file_name)
+            if self.source_paths.get(file_name) == source_path:
+                self.templates.remove(file_name)
+                self.source_hashes.pop(file_name)
+                self.source_paths.pop(file_name)
+                self.context_propertys.pop(file_name)
+                stem = os.path.splitext(file_name)[0]
+                if self.template_name_map.get(stem) == file_name:
+                    del self.template_name_map[stem]
+                if file_name in self.includes:
+                    self.includes.remove(file_name)
+            if os.path.exists(path):
+                self._scan_file(folder, file_name)
+            else:
+                self.index.discard(source_path)
+
+
+    def _template_info(self, file_name):
+        """
+        模板的静态信息: 引用的模板, 是否使用文章集合, 是否读取文章正文.
+        按源文件哈希记录在清单中, 未变化的模板无需再读取和解析
+        """
+        source_hash = self.source_hashes.get(file_name)
+        info = self._refs.get(source_hash) or self.manifest.refs.get(source_hash)
+        if info is None:
+            source = self.templates.get(file_name) or u''
+            if not has_template_syntax(source):
+                # 不含模板语法的文章没有任何引用, 不必解析
+                ast = nodes.Template([])
+            else:
+                try:
+                    ast = self.env.parse(source)
+                except TemplateSyntaxError:
+                    # 渲染时会报告语法错误
+                    ast = nodes.Template([])
+            info = template_usage(ast)
+            info['refs'] = list(meta.find_referenced_templates(ast))
+        if source_hash is not None:
+            self._refs[source_hash] = info
+        return info
+
+    def _template_refs(self, file_name):
+        """
+        模板直接依赖的其他模板: include/import/extends 引用的模板以及头部声明的layout
+        :param file_name: 模板文件名
+        :return: 文件名集合
+        """
+        refs = set()
+        for name in self._template_info(file_name)['refs']:
+            if name is None:
+                # 动态引用, 无法确定具体文件, 视为依赖全部include
+                refs.update(self.includes)
+            else:
+                refs.add(name)
+        layout = self.context_propertys.get(file_name, {}).get('layout')
+        if layout in self.template_name_map:
+            refs.add(self.template_name_map[layout])
+        return refs
+
+    def _template_closure(self, file_name):
+        """
+        模板的全部传递依赖(包含自身)
+        """
+        if file_name not in self._closures:
+            closure = set()
+            pending = [file_name]
+            while pending:
+                name = pending.pop()
+                if name in closure:
+                    continue
+                closure.add(name)
+                pending.extend(self._template_refs(name))
+            self._closures[file_name] = closure
+        return self._closures[file_name]
+
+    def _collection_digest(self):
+        """
+        文章集合的哈希
+        :return: (不含正文的摘要哈希, 正文哈希)
+        """
+        if self._collection_digests is None:
+            pages = [dict(url=page.url,
+                          title=page.title,
+                          meta=dict((k, v) for k, v in iteritems(page.meta) if k != 'date'))
+                     for page in self.site.pages]
+            # 文章正文只由源文件和markdown配置决定, 用源文件哈希代替正文
+            self._collection_digests = (content_hash(digest_object(pages),
+                                                     *[self._post_digest(post)[0] for post in self.site.posts]),
+                                        content_hash(*[self.source_hashes.get(post.source, '')
+                                                       for post in self.site.posts]))
+        return self._collection_digests
+
+    def _post_digest(self, post):
+        """
+        文章摘要的哈希, 头部数据由源文件决定, 源文件和摘要未变时沿用上次构建的结果
+        :return: (列表页使用的摘要哈希, 相关文章使用的摘要哈希)
+        """
+        key = (post.source, self.source_hashes.get(post.source), post.description, post.page_image)
+        digests = self._post_digests.get(key) or self._previous_post_digests.get(key)
+        if digests is None:
+            digests = (digest_object(dict(url=post.url,
+                                          title=post.title,
+                                          date=post.date,
+                                          author=post.author,
+                                          tags=sorted(post.tags),
+                                          description=post.description,
+                                          page_image=post.page_image,
+                                          meta=dict((k, v) for k, v in iteritems(post.meta) if k != 'date'))),
+                       digest_object([post.url, post.title, post.date, post.description, post.page_image]))
+        self._post_digests[key] = digests
+        return digests
+
+    def _fragment_inputs(self):
+        """
+        持久化片段缓存的输入哈希: 文章以外的源文件, 配置, 资源和文章集合
+        :return: (不含正文, 含正文)
+        """
+        parts = [self.config_hash, self.assets_digest, self.images_digest]
+        parts.extend(u"%s:%s" % (name, digest) for name, digest in sorted(iteritems(self.source_hashes))
+                     if not self.context_propertys.get(name, {}).get('is_content'))
+        summary, full = self._collection_digest()
+        return content_hash(summary, *parts), content_hash(summary, full, *parts)
+
+    def _dependency_key(self, context):
+        """
+        计算页面输出的依赖哈希, 任一输入变化时哈希随之变化
+        """
+        closure = self._template_closure(context['page'].key)
+        parts = [self.config_hash]
+        parts.extend(u"%s:%s" % (name, self.source_hashes.get(name, '')) for name in sorted(closure))
+        infos = [self._template_info(name) for name in closure]
+        if context.get('is_archive') or any(info['collection'] for info in infos):
+            summary, full = self._collection_digest()
+            parts.append(summary)
+            if any(info['content'] for info in infos):
+                parts.append(full)
+        if any(info['assets'] for info in infos):
+            parts.append(self.assets_digest)
+        if any(info['images'] for info in infos):
+            parts.extend([self.assets_digest, self.images_digest])
+        if any(info['related'] for info in infos):
+            parts.append(self._related_digest(context['post']))
+        return content_hash(*parts)
+
+    def _related_digest(self, post):
+        """
+        相关文章的哈希: 文章页取其相关文章的摘要, 其他页面取全部文章的相关文章列表
+        """
+        if post is not None:
+            return content_hash(*[self._post_digest(item)[1] for item in post.related])
+        if self._related_all is None:
+            self._related_all = content_hash(*[u' '.join(item.url for item in post.related)
+                                               for post in self.site.posts])
+        return self._related_all
 
     def _render(self, layout, context):
+        """
+        渲染layout链, 整条链合并为一个模板一次渲染完成
+        """
+        chain = self._layout_chain(layout)
+        if len(chain) < 2 or any(INHERITANCE_RE.search(self.templates.get(name) or u'') for name in chain):
+            return self._render_layers(layout, context)
+        name = CHAIN_PREFIX + '>'.join(chain)
+        with self.profiler.phase('compile', name):
+            template = self.env.get_template(name)
+        self._layer = None
+        html = template.render(**context)
+        context['content'] = html
+        return html
+
+    def _layer_mark(self, file_name):
+        """
+        合并的layout链中每层开始和整条链结束时调用, 把上一层的耗时记在render阶段
+        """
+        now = default_timer()
+        if self._layer is not None:
+            self.profiler.record('render', self._layer[0], now - self._layer[1])
+        self._layer = (file_name, now) if file_name is not None else None
+        return u''
+
+    def _render_layers(self, layout, context):
         """
         递归渲染模板
         """
         if layout and layout in self.template_name_map:
-            template = self.env.get_template(self.template_name_map.get(layout))
-            html = template.render(**context)
+            with self.profiler.phase('render', self.template_name_map.get(layout)):
+                template = self.env.get_template(self.template_name_map.get(layout))
+                html = template.render(**context)
             context['content'] = html
             file_name = self.template_name_map.get(layout)
             ppt = self.context_propertys.get(file_name)
             if ppt:
-                return self._render(ppt.get('layout'), context)
+                return self._render_layers(ppt.get('layout'), context)
             return html
         return context['content']
 
@@ -343,33 +1761,57 @@ class Generator(object):
             layout = os.path.splitext(context['page'].file_name)[0]
 
         if context.get('is_archive'):
-            # TODO: 执行归档渲染的逻辑
-            for archive_dt in self.archives:
-                self.archive.posts = []
-                self.archive.category = archive_dt
-                for post in self.site.posts:
-                    key = "%s-%s" % (post.date.year, post.date.month)
-                    self.archive.year = post.date.year
-                    self.archive.month = post.date.month
-                    if key == archive_dt:
-                        self.archive.posts.append(post)
+            page = context['page']
+            page_size = page.page_size
+            for category, posts in self.site.index.archives(page.archive):
+                self.archive = Archive()
+                self.archive.kind = page.archive
+                self.archive.category = category
+                self.archive.slug = self.site.index.slug(page.archive, category)
+                self.archive.posts = posts
+                if page.archive == 'tag':
+                    self.archive.tag = category
+                elif page.archive == 'year':
+                    self.archive.year = category
+                else:
+                    self.archive.year, self.archive.month = map(int, category.split('-'))
                 context['archive'] = self.archive
-                html = self._render(layout, context)
-                self.dump_file(html, context)
+                if page_size > 0:
+                    # 每个归档分类单独分页
+                    total_pages = max(1, (len(posts) + page_size - 1) // page_size)
+                    for pid in range(total_pages):
+                        self.paginator.page = pid + 1
+                        self.paginator.per_page = page_size
+                        self.paginator.posts = posts[pid * page_size: (pid + 1) * page_size]
+                        self.paginator.total_posts = len(posts)
+                        self.paginator.total_pages = total_pages
+                        self.paginator.previous_page = pid if pid else None
+                        self.paginator.previous_page_path = "/%s" % self._archive_path(page, category, pid) \
+                            if pid else None
+                        self.paginator.next_page = pid + 2 if pid + 1 < total_pages else None
+                        self.paginator.next_page_path = "/%s" % self._archive_path(page, category, pid + 2) \
+                            if pid + 1 < total_pages else None
+                        context['paginator'] = self.paginator
+                        html = self._render(layout, context)
+                        self.dump_file(html, context)
+                else:
+                    html = self._render(layout, context)
+                    self.dump_file(html, context)
 
         else:
             if self.paginator and context['page'].page_size > 0:
-                click.echo('paging......')
+                self.echo('paging......')
                 page_size = context['page'].page_size
-                all_items = self.site.posts
+                self.paginator.previous_page_path = None
+                self.paginator.next_page_path = None
+                sorts = []
                 if context['page'].page_sort:
                     key, direction = context['page'].page_sort.split('=')
-                    if direction.lower() == 'desc':
-                        all_items = sorted(all_items, key=lambda item: item.meta[key], reverse=True)
-                    else:
-                        all_items = sorted(all_items, key=lambda item: item.meta [key])
+                    sorts.append((key, direction.lower() == 'desc'))
+                filters = []
                 if context['page'].page_filter:
-                    all_items = query_list(all_items, context['page'].page_filter)
+                    filters = parse_query(context['page'].page_filter)
+                all_items = self.site.index.select(filters, sorts)
 
                 self.paginator.total_posts = len(all_items)
                 self.paginator.total_pages = self.paginator.total_posts / page_size
@@ -402,25 +1844,35 @@ class Generator(object):
         """
         输出到文件
         """
-        base_path = os.path.join(os.getcwd(), SITE_FOLDER)
+        file_path = self._output_path(context)
+        with self.profiler.phase('dump'):
+            written = write_if_changed(file_path, html.encode('utf8'))
+        self.outputs.append(os.path.relpath(file_path, self.output_root))
+        if written:
+            self.written += 1
+            self.echo(context['page'].file_name + " process ok!")
+        else:
+            self.echo(context['page'].file_name + " unchanged")
+
+    def _output_path(self, context):
+        """
+        计算输出文件路径, 必要时创建目录
+        """
+        base_path = self.output_root
         if context['post']:
             dir_path = os.path.join(base_path, context['page'].directory)
             if not os.path.exists(dir_path):
                 os.mkdir(dir_path)
             file_path = os.path.join(dir_path, context['page'].file_name)
         else:
-            if self.open_archive and context.get('archive'):
+            if context.get('archive'):
                 archive_dir_path = os.path.join(base_path, 'archive')
                 if not os.path.exists(archive_dir_path):
                     os.mkdir(archive_dir_path)
 
-                archive = context['archive']
-                file_name = context['page'].file_name
-                file_path = os.path.join(archive_dir_path, "%s_%s%s" % (
-                    os.path.splitext(file_name)[0],
-                    archive.category,
-                    os.path.splitext(file_name)[1]
-                ))
+                page_num = self.paginator.page if context['page'].page_size > 0 else 1
+                file_path = os.path.join(base_path, self._archive_path(
+                    context['page'], context['archive'].category, page_num))
             else:
                 if self.paginator and context['page'].page_size > 0:
                     if self.paginator.page>1:
@@ -434,47 +1886,188 @@ class Generator(object):
                         file_path = os.path.join(base_path, context['page'].file_name)
                 else:
                     file_path = os.path.join(base_path, context['page'].file_name)
-        with open(file_path, 'w+') as f:
-            f.write(html.encode('utf8'))
-        click.echo(context['page'].file_name + " process ok!")
-
-
-    def move_ext_dictionary(self):
-        tar_path = os.path.join(os.getcwd(), SITE_FOLDER)
-        will_delete_path = os.listdir(tar_path)
-        for filename in will_delete_path:
-            if not filename.startswith('.'):
-                target_file_path = os.path.join(tar_path, filename)
-                if os.path.isdir(target_file_path):
-                    shutil.rmtree(target_file_path)
-                else:
-                    os.remove(target_file_path)
-
-        asset_path = os.path.join(os.getcwd(), ASSETS_FOLDER)
-        paths = os.listdir(asset_path)
-        
-        for filename in paths:
-            src_path = os.path.join(asset_path, filename)
-            if os.path.isfile(src_path):
-                shutil.copy(src_path, os.path.join(tar_path, filename))
-            else:
-                shutil.copytree(src_path, os.path.join(tar_path, filename))
-            click.echo('copy %s to %s done' % (src_path, tar_path))
-
-    def _parse_content_image(self, md_txt):
-        images_list = re.findall(r'!\[\S*?]\((.+?)\)', md_txt)
-        return images_list[0] if images_list else ''
+        return file_path
 
-    def _parse_content_dis(self, md_txt):
-        for line in md_txt.split('\n'):
-            if not line.strip():
-                continue
-            if not self._parse_content_image(line):
-                return line
+    def _archive_path(self, page, category, page_num=1):
+        """
+        归档页面相对于输出目录的路径, 分页从第二页起加页码后缀
+        """
+        name, ext = os.path.splitext(page.file_name)
+        slug = self.site.index.slug(page.archive, category)
+        if page_num > 1:
+            return "archive/%s_%s_%s%s" % (name, slug, page_num, ext)
+        return "archive/%s_%s%s" % (name, slug, ext)
 
-    def parse_file(self):
-        self.move_ext_dictionary()
+    def _remove_outputs(self, paths):
+        """
+        删除源文件已不存在的输出, 并清理空目录
+        """
+        base_path = self.output_root
+        for path in sorted(paths):
+            file_path = os.path.join(base_path, path)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+                self.echo('remove %s' % path)
+            for encoding in COMPRESSED_EXTS:
+                if os.path.isfile("%s.%s" % (file_path, encoding)):
+                    os.remove("%s.%s" % (file_path, encoding))
+            dir_path = os.path.dirname(file_path)
+            while dir_path != base_path and os.path.isdir(dir_path) and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+                dir_path = os.path.dirname(dir_path)
+
+    def _hash_outputs(self, paths):
+        """
+        计算输出文件及其预压缩文件的哈希, mtime和大小未变时沿用清单中的记录;
+        不记录增量时不计算哈希, 变化的文件记为None
+        :return: {路径: [mtime, 大小, sha1]}
+        """
+        base_path = self.output_root
+        files = {}
+        for path in paths:
+            for file_name in [path] + ["%s.%s" % (path, encoding) for encoding in COMPRESSED_EXTS]:
+                file_path = os.path.join(base_path, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                record = self.manifest.files.get(file_name)
+                if not record or record[0] != stat.st_mtime or record[1] != stat.st_size:
+                    record = [stat.st_mtime, stat.st_size, None]
+                if record[2] is None and self.record_delta:
+                    record = [stat.st_mtime, stat.st_size, file_digest(file_path)]
+                files[file_name] = record
+        return files
+
+    def _site_files(self):
+        """
+        输出目录中的全部文件, 不含顶层的隐藏文件和仍有原文件的预压缩文件
+        """
+        base_path = self.output_root
+        paths = set()
+        for dir_path, dir_names, file_names in os.walk(base_path):
+            if dir_path == base_path:
+                dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+                file_names = [name for name in file_names if not name.startswith('.')]
+            for file_name in file_names:
+                root, ext = os.path.splitext(file_name)
+                if ext[1:] in COMPRESSED_EXTS and os.path.isfile(os.path.join(dir_path, root)):
+                    continue
+                paths.add(os.path.relpath(os.path.join(dir_path, file_name), base_path))
+        return paths
+
+    def move_ext_dictionary(self, clean=True):
+        """
+        同步静态资源: 只复制新增或变化的文件, 删除已不存在的资源.
+        开启asset_fingerprint时另外输出带内容哈希的文件name.<hash>.ext及其清单
+        :param clean: 为True时先清空输出目录
+        """
+        tar_path = self.output_root
+        if clean:
+            will_delete_path = os.listdir(tar_path)
+            for filename in will_delete_path:
+                if not filename.startswith('.'):
+                    target_file_path = os.path.join(tar_path, filename)
+                    if os.path.isdir(target_file_path):
+                        shutil.rmtree(target_file_path)
+                    else:
+                        os.remove(target_file_path)
+
+        asset_path = os.path.join(self.root, ASSETS_FOLDER)
+        use_hash = bool(getattr(self.site, 'asset_hash', False))
+        link_mode = getattr(self.site, 'asset_link', 'copy')
+        fingerprint = getattr(self.site, 'asset_fingerprint', False)
+        if fingerprint is True:
+            fingerprint = FINGERPRINT_EXTS
+        fingerprint = set(ext.lower().lstrip('.') for ext in fingerprint or [])
+        image_exts = set()
+        if getattr(self.site, 'images', None):
+            from .images import IMAGE_EXTS
+            image_exts = set(IMAGE_EXTS)
+        asset_digests = {}
+        assets = []
+        asset_urls = {}
+        hashed_sources = []
+        copied = skipped = copied_bytes = skipped_bytes = 0
+        for dir_path, dir_names, file_names in os.walk(asset_path):
+            dir_names.sort()
+            for filename in sorted(file_names):
+                src_path = os.path.join(dir_path, filename)
+                rel_path = os.path.relpath(src_path, asset_path)
+                stat = os.stat(src_path)
+                size = stat.st_size
+                targets = [rel_path]
+                root, ext = os.path.splitext(rel_path)
+                if ext[1:].lower() in fingerprint or ext[1:].lower() in image_exts:
+                    digest = self.index.asset_digest(src_path, stat.st_mtime, size)
+                    hashed_sources.append(src_path)
+                    asset_digests[rel_path.replace(os.sep, '/')] = digest
+                if ext[1:].lower() in fingerprint:
+                    hashed_path = '%s.%s%s' % (root, digest[:FINGERPRINT_LENGTH], ext)
+                    asset_urls[rel_path.replace(os.sep, '/')] = hashed_path.replace(os.sep, '/')
+                    targets.append(hashed_path)
+                for target in targets:
+                    dst_path = os.path.join(tar_path, target)
+                    assets.append(target)
+                    if asset_unchanged(src_path, dst_path, use_hash):
+                        skipped += 1
+                        skipped_bytes += size
+                        continue
+                    dst_dir = os.path.dirname(dst_path)
+                    if not os.path.exists(dst_dir):
+                        os.makedirs(dst_dir)
+                    link_or_copy(src_path, dst_path, link_mode)
+                    copied += 1
+                    copied_bytes += size
+        self.index.commit_assets(hashed_sources)
+        if asset_urls:
+            write_if_changed(os.path.join(tar_path, ASSET_MANIFEST),
+                             json.dumps(asset_urls, indent=2, sort_keys=True).encode('utf-8'))
+            assets.append(ASSET_MANIFEST)
+        self.asset_urls = asset_urls
+        self.assets_digest = digest_object(asset_urls)
+        self.asset_digests = asset_digests
+
+        stale_assets = set(self.manifest.assets) - set(assets) if not clean else set()
+        self._remove_outputs(stale_assets)
+        self.manifest.assets = assets
+        self.echo('assets: %s copied (%s bytes), %s unchanged (%s bytes), %s removed' % (
+            copied, copied_bytes, skipped, skipped_bytes, len(stale_assets)))
+
+    def parse_file(self, full=False, select=None, listings=False):
+        """
+        生成站点, 默认只重新渲染依赖发生变化的输出
+        :param full: 是否强制全量生成
+        :param select: 部分生成, 只渲染选中的页面, 其他输出和静态资源保持不变
+        :param listings: 部分生成时同时刷新使用文章集合的列表页
+        """
+        partial = select is not None
+        with self.profiler.phase('manifest'):
+            loaded = self.manifest.load()
+        self.full_build = not partial and (full or not loaded)
+        self.site.pages = []
+        self.site.posts = []
+        self.site.tags = ()
+        self.paginator = Paginator()
+        self.archive = Archive()
+        self.open_archive = False
+        self.archives = []
+        self._closures = {}
+        self._refs = {}
+        self._collection_digests = None
+        self._related_all = None
+        self._post_digests, self._previous_post_digests = {}, self._post_digests
+        self.env.fragment_memo = {}
+        self.env.fragment_store = self.fragment_cache
+        self.env.fragment_inputs = None
+        with self.profiler.phase('assets'):
+            if partial:
+                self._load_asset_urls()
+            else:
+                # 不再清空输出目录, 全量生成结束后统一清理多余的文件, 保留未变化文件的mtime
+                self.move_ext_dictionary(clean=False)
         contexts = []
+        post_contexts = []
         for file_name, property in iteritems(self.context_propertys):
             if 'layout' not in property:
                 continue
@@ -492,56 +2085,517 @@ class Generator(object):
                 page.page_size = int(property.get('page_size', '0'))
                 page.page_filter = property.get('page_filter', '')
                 page.page_sort = property.get('page_sort', '')
-                page.template_instance = self.env.get_template(file_name)
-                page.template_str = self.templates.get(file_name)
+                page.environment = self.env
+                page.template_source = self.templates
                 context = dict(page=page, content="", post=None, site=self.site, paginator=self.paginator, is_archive=False)
-                if page.file_name == 'archive.html':
+                page.archive = property.get('archive', 'month' if page.file_name == 'archive.html' else '')
+                if page.archive:
                     context['is_archive'] = True
                     self.open_archive = True
                 if property.get('is_content'):
                     dt, dt_str, save_name = self._parse_filename(file_name)
-                    raw_content = page.template_instance.render(content='')
                     post = Post()
+                    post.source = file_name
                     page.is_post = True
                     post.url = u"/%s/%s" % (dt_str.decode('utf-8'), save_name.decode('utf-8'))
                     page.url = post.url
                     post.date = dt
                     post.title = property.get('title')
                     post.author = property.get('author', 'anonymous')
-                    post.content = markdown.markdown(raw_content)
-                    post.tags = set(property.get('tags', '').split(','))
-                    self.site.tags = set(list(self.site.tags) + list(post.tags))
+                    post.tags = set(tag.strip() for tag in property.get('tags', '').split(',') if tag.strip())
+                    post.related = []
                     page.file_name = save_name
                     page.directory = dt_str
                     post.meta = property
                     post.date = dt
-                    page.page_image = self._parse_content_image(raw_content)
-                    post.page_image = page.page_image
-                    post.description = self._parse_content_dis(raw_content)
-                    # if page.page_image:
-                    #     click.echo("image:%s" % page.page_image)
                     context['post'] = post
                     context['page'] = page
-                    context['content'] = post.content
                     self.site.posts.append(post)
+                    post_contexts.append(context)
                 if property.get('is_page'):
                     if not os.path.splitext(file_name)[0] == 'index':
                         self.site.pages.append(page)
                 contexts.append(context)
 
-        if self.open_archive:
-            archive_dates = []
-            for post in self.site.posts:
-                key = "%s-%s" % (post.date.year, post.date.month)
-                archive_dates.append(key)
-            archive_dates = sorted(list(set(archive_dates)), reverse=True)
-            self.archives = archive_dates
-            self.site.archives = self.archives
+        selected = set(id(context) for context in contexts if select(context)) if partial else None
+        image_urls = set()
+        with self.profiler.phase('posts'):
+            # 记录过摘要的文章不读取正文, 渲染或列表页读取正文时再加载
+            summary_keys = {}
+            stored = {}
+            for context in post_contexts:
+                key = self._summary_key(context['page'].key)
+                summary = self.index.summary(key) if key else None
+                if summary is not None:
+                    stored[id(context)] = summary
+                summary_keys[id(context)] = key
+            pending = [context for context in post_contexts if id(context) not in stored]
+            if partial:
+                # 未选中的文章只需要摘要
+                converted = [context for context in pending if id(context) in selected and not self.stream]
+                summarized = [context for context in pending if id(context) not in selected or self.stream]
+            elif self.stream:
+                converted, summarized = [], pending
+            else:
+                converted, summarized = pending, []
+            recorded = [context for context in post_contexts if id(context) in stored]
+            for context in recorded + summarized:
+                context['post'].loader = self._load_content
+            for method, group in ((None, recorded), ('_convert_post', converted), ('_summarize_post', summarized)):
+                if method is None:
+                    results = [[None] + stored[id(context)] for context in group]
+                else:
+                    results = self._map(method, [(context['page'].key, context['page'].key) for context in group])
+                for context, result in zip(group, results):
+                    post, page = context['post'], context['page']
+                    post.content, page.page_image, post.description, post.headings = result[:4]
+                    post.page_image = page.page_image
+                    context['content'] = result[0]
+                    image_urls.add(page.page_image)
+                    image_urls.update(result[4])
+                    key = summary_keys[id(context)]
+                    if method is not None and key:
+                        self.index.put_summary(key, result[1:])
+            self.index.commit_summaries(None if partial else [key for key in summary_keys.values() if key])
+            self.markdown_cache.evict()
+        images_entry = None
+        images_written = 0
+        if partial:
+            self.image_urls = self.manifest.entries.get(IMAGES_ENTRY, {}).get('urls', {})
+        elif getattr(self.site, 'images', None):
+            with self.profiler.phase('images'):
+                images_entry, images_written = self._image_derivatives(
+                    image_urls, self.manifest.entries.get(IMAGES_ENTRY))
+            self.image_urls = images_entry['urls']
+        else:
+            self.image_urls = {}
+        self.images_digest = digest_object(self.image_urls)
+
+        with self.profiler.phase('index'):
+            self.site.posts.sort(key=lambda item:item.date, reverse=True)
+            self.site.index = SiteIndex(self.site.posts)
+            self.site.posts = self.site.index.posts
+            self.site.tags = set(self.site.index.tags)
+            if self.open_archive:
+                self.archives = [key for key, _ in self.site.index.archives('month')]
+                self.site.archives = self.archives
+        if getattr(self.site, 'related', None):
+            with self.profiler.phase('related'):
+                self._related_posts()
+        # 文章转换阶段的文章集合尚不完整, 渲染页面前清空片段
+        self.env.fragment_memo = {}
+        with self.profiler.phase('index'):
+            self.env.fragment_inputs = self._fragment_inputs()
+
+        previous_outputs = self._site_files() if self.full_build else self.manifest.outputs()
+        # 部分生成保留其他页面在清单中的记录
+        entries = dict(self.manifest.entries) if partial else {}
+        pending = []
+        keys = []
+        for context in contexts:
+            file_name = context['page'].key
+            if partial and id(context) not in selected and not (listings and self._is_listing(context)):
+                continue
+            with self.profiler.phase('dependencies'):
+                key = self._dependency_key(context)
+            entry = self.manifest.entries.get(file_name)
+            if not self.full_build and not partial and entry and entry.get('key') == key \
+                    and self._outputs_exist(entry):
+                entries[file_name] = entry
+                continue
+            pending.append(context)
+            keys.append(key)
+
+        self._pending = pending
+        results = self._map('_render_task', [(context['page'].key, idx)
+                                             for idx, context in enumerate(pending)])
+        self._pending = []
+        written = images_written
+        if images_entry is not None:
+            entries[IMAGES_ENTRY] = images_entry
+        for context, key, (outputs, count) in zip(pending, keys, results):
+            entries[context['page'].key] = dict(key=key, outputs=outputs)
+            written += count
+        rendered = len(pending)
+        if getattr(self.site, 'search', None) and not partial:
+            with self.profiler.phase('search'):
+                entries[SEARCH_ENTRY], count = self._search_index(self.manifest.entries.get(SEARCH_ENTRY))
+            written += count
+
+        current_outputs = set()
+        for entry in entries.values():
+            current_outputs.update(entry['outputs'])
+        if partial:
+            # 只处理本次渲染的页面, 删除的只是它们不再生成的旧输出
+            outputs = set()
+            previous_outputs = set()
+            for context in pending:
+                outputs.update(entries[context['page'].key]['outputs'])
+                previous_outputs.update(self.manifest.entries.get(context['page'].key, {}).get('outputs', []))
+            stale_outputs = previous_outputs - current_outputs
+            paths = sorted(outputs)
+        else:
+            outputs = current_outputs
+            stale_outputs = previous_outputs - current_outputs - set(self.manifest.assets)
+            paths = sorted(outputs) + self.manifest.assets
+        self._remove_outputs(stale_outputs)
+        with self.profiler.phase('precompress'):
+            self.precompress(paths)
+        with self.profiler.phase('delta'):
+            files = {}
+            if partial:
+                for path, record in iteritems(self.manifest.files):
+                    root, ext = os.path.splitext(path)
+                    if (root if ext[1:] in COMPRESSED_EXTS else path) not in stale_outputs:
+                        files[path] = record
+            files.update(self._hash_outputs(paths))
+        self.delta = output_delta(self.manifest.files, files) if self.record_delta else None
+        self.manifest.files = files
+
+        self.manifest.entries = entries
+        if partial:
+            self.manifest.refs.update(self._refs)
+        else:
+            self.manifest.refs = self._refs
+        self.manifest.sources = dict((self.source_paths[name], digest)
+                                     for name, digest in iteritems(self.source_hashes))
+        self.fragment_cache.evict()
+        with self.profiler.phase('manifest'):
+            self.manifest.save()
+        self.stats = dict(posts=len(self.site.posts),
+                          rendered=rendered,
+                          skipped=len(contexts) - rendered,
+                          written=written,
+                          unchanged=len(outputs) - written,
+                          removed=len(stale_outputs))
+        self.echo("pages: %s rendered, %s skipped; files: %s written, %s unchanged, %s removed" % (
+            rendered, len(contexts) - rendered, written, len(outputs) - written, len(stale_outputs)))
+
+    def _related_posts(self):
+        """
+        计算每篇文章的相关文章, 设置post.related
+        """
+        from .related import RelatedIndex, RELATED_LIMIT, RELATED_MAX_DF
+        config = getattr(self.site, 'related')
+        if not isinstance(config, dict):
+            config = {}
+        params = dict(limit=int(config.get('limit', RELATED_LIMIT)),
+                      text=bool(config.get('text', False)),
+                      max_df=float(config.get('max_df', RELATED_MAX_DF)))
+        index = self._related_index
+        # 常驻的生成器沿用内存中的索引, 参数变化时重新读取; 全量生成不使用缓存
+        if self.full_build or index is None or \
+                dict(limit=index.limit, text=index.text, max_df=index.max_df) != params:
+            index = RelatedIndex(os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'related.json'),
+                                 load=not self.full_build, **params)
+            self._related_index = index
+        index.update(self.site.posts)
+        if index.dirty:
+            index.save()
+        self.echo("related posts: %s post(s), %s computed" % (len(self.site.posts), index.computed))
+
+    def _image_derivatives(self, urls, previous):
+        """
+        为文章用到的站内图片生成缩略图和不同宽度的衍生图, 图片和参数都没有变化时沿用上次的输出
+        :param urls: 首图和正文中的图片url
+        :param previous: 清单中上次的图片条目
+        :return: (清单条目, 写入的文件数)
+        """
+        from .images import Image, ImageCache, IMAGE_FOLDER, image_path, image_params, resize_image
+        params = image_params(getattr(self.site, 'images'))
+        sources = {}
+        for url in urls:
+            path = image_path(url)
+            if path in self.asset_digests:
+                sources[path] = self.asset_digests[path]
+        link_mode = getattr(self.site, 'asset_link', 'copy')
+        key = digest_object([params, sorted(iteritems(sources)), link_mode])
+        if not self.full_build and previous and previous.get('key') == key and self._outputs_exist(previous):
+            return previous, 0
+        if Image is None:
+            self.echo("images: Pillow is not installed, no derivatives generated")
+            return dict(key='', outputs=[], urls={}), 0
+
+        cache = ImageCache(os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'images'), params)
+        cache_keys = dict((path, cache.key(digest)) for path, digest in iteritems(sources))
+        metas = {}
+        tasks = []
+        for path in sorted(sources):
+            meta = cache.get(cache_keys[path])
+            if meta is None:
+                tasks.append((path, (os.path.join(self.root, ASSETS_FOLDER, *path.split('/')),
+                                     cache.entry_path(cache_keys[path]), params)))
+            else:
+                metas[path] = meta
+        if len(tasks) > 1 and hasattr(os, 'fork'):
+            pool = multiprocessing.Pool(min(len(tasks), self.jobs if self.jobs > 1 else multiprocessing.cpu_count()))
+            try:
+                results = pool.map(resize_image, [task for _, task in tasks])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [resize_image(task) for _, task in tasks]
+        for (path, _), meta in zip(tasks, results):
+            if meta is None:
+                self.echo("images: can not read %s, skipped" % path)
+            else:
+                metas[path] = meta
+
+        outputs = []
+        image_urls = {}
+        written = 0
+        for path, meta in sorted(iteritems(metas)):
+            cache_key = cache_keys[path]
+            root, ext = os.path.splitext(path)
+            info = dict(format=ext[1:].lower(), width=meta['size'][0], height=meta['size'][1],
+                        thumbnail={}, srcset={})
+            for label, image_format, width, file_name in meta['variants']:
+                target = '%s/%s.%s.%s.%s' % (IMAGE_FOLDER, root, cache_key[:FINGERPRINT_LENGTH], label, image_format)
+                src_path = os.path.join(cache.entry_path(cache_key), file_name)
+                dst_path = os.path.join(self.output_root, *target.split('/'))
+                if not asset_unchanged(src_path, dst_path):
+                    dst_dir = os.path.dirname(dst_path)
+                    if not os.path.exists(dst_dir):
+                        os.makedirs(dst_dir)
+                    link_or_copy(src_path, dst_path, link_mode)
+                    written += 1
+                outputs.append(target)
+                if label == 'thumb':
+                    info['thumbnail'][image_format] = '/' + target
+                else:
+                    info['srcset'].setdefault(image_format, []).append([width, '/' + target])
+            image_urls[path] = info
+        cache.evict(cache_keys[path] for path in metas)
+        self.echo("images: %s image(s), %s resized, %s file(s) written" % (len(sources), len(tasks), written))
+        return dict(key=key, outputs=outputs, urls=image_urls), written
 
-        self.site.posts.sort(key=lambda item:item.date, reverse=True)
+    def _search_index(self, previous):
+        """
+        生成站内搜索索引, 文章没有变化时沿用上次的输出
+        :param previous: 清单中上次的搜索索引条目
+        :return: (清单条目, 写入的文件数)
+        """
+        from .search import SearchIndex, SEARCH_FOLDER, SEARCH_SHARDS, SEARCH_VERSION
+        config = getattr(self.site, 'search')
+        if not isinstance(config, dict):
+            config = {}
+        shards = int(config.get('shards', SEARCH_SHARDS))
+        # 按时间正序编号, 新文章追加在末尾, 已有文章的倒排表保持不变
+        posts = sorted(self.site.posts, key=lambda item: (item.date, item.url))
+        doc_keys = [content_hash(self.markdown_cache.salt, self.source_hashes.get(post.source, ''))
+                    for post in posts]
+        key = digest_object([SEARCH_VERSION, shards, doc_keys, [post.url for post in posts]])
+        if not self.full_build and previous and previous.get('key') == key and self._outputs_exist(previous):
+            return previous, 0
+
+        index = SearchIndex(os.path.join(self.root, STATE_FOLDER, CACHE_FOLDER, 'search.json'), shards)
+        for post, doc_key in zip(posts, doc_keys):
+            index.add(doc_key, post.url, post.title, post.date,
+                      lambda: (post.title, post.tags, post.content))
+        dir_path = os.path.join(self.output_root, SEARCH_FOLDER)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        outputs = []
+        written = 0
+        for file_name, data in sorted(iteritems(index.build())):
+            if write_if_changed(os.path.join(dir_path, file_name), data):
+                written += 1
+            outputs.append(os.path.join(SEARCH_FOLDER, file_name))
+        index.save()
+        self.echo("search index: %s post(s), %s tokenized, %s file(s) written" % (
+            len(posts), index.tokenized, written))
+        return dict(key=key, outputs=outputs), written
+
+    def precompress(self, paths):
+        """
+        按配置为输出文件生成预压缩文件, 供nginx的gzip_static/brotli_static使用,
+        已有且不早于原文件的压缩文件不会重新生成
+        :param paths: 相对于输出目录的路径
+        """
+        base_path = self.output_root
+        config = getattr(self.site, 'precompress', None)
+        if not config:
+            # 关闭预压缩后删除旧的压缩文件, 避免服务器返回过期内容
+            known = set(paths)
+            for path in paths:
+                for encoding in COMPRESSED_EXTS:
+                    target_path = "%s.%s" % (os.path.join(base_path, path), encoding)
+                    if "%s.%s" % (path, encoding) not in known and os.path.isfile(target_path):
+                        os.remove(target_path)
+            return
+        if not isinstance(config, dict):
+            config = {}
+        encodings = []
+        if config.get('gzip', True):
+            encodings.append('gz')
+        if config.get('brotli', True) and brotli is not None:
+            encodings.append('br')
+        min_size = int(config.get('min_size', PRECOMPRESS_MIN_SIZE))
+        exts = set('.%s' % ext.lstrip('.') for ext in config.get('extensions', PRECOMPRESS_EXTS))
+
+        tasks = []
+        for path in paths:
+            file_path = os.path.join(base_path, path)
+            if os.path.splitext(path)[1] not in exts or not os.path.isfile(file_path):
+                continue
+            stat = os.stat(file_path)
+            if stat.st_size < min_size:
+                continue
+            stale = []
+            for encoding in encodings:
+                target_path = "%s.%s" % (file_path, encoding)
+                if not os.path.exists(target_path) or os.stat(target_path).st_mtime < stat.st_mtime:
+                    stale.append(encoding)
+            if stale:
+                tasks.append((file_path, stale))
+        if not tasks:
+            return
+        pool = ThreadPool(min(len(tasks), self.jobs if self.jobs > 1 else multiprocessing.cpu_count()))
+        try:
+            pool.map(compress_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        self.echo("precompressed %s file(s)" % len(tasks))
+
+    def _renderer(self, file_name):
+        return self.renderers[os.path.splitext(file_name)[1][1:].lower()]
+
+    def _post_text(self, file_name):
+        """
+        文章经模板渲染后的正文, 不含模板语法的文章直接使用源文件, 不编译模板
+        """
+        text = self.templates[file_name]
+        if not has_template_syntax(text):
+            return plain_text(text)
+        with self.profiler.phase('post_template', file_name):
+            return self.env.get_template(file_name).render(content='')
 
-        for context in contexts:
+    def _summary_key(self, file_name):
+        """
+        文章摘要的记录键, 由源文件, markdown配置, 站点配置和引用的模板决定;
+        正文使用文章集合, 资源或图片时摘要随其他文章变化, 不记录
+        :return: 键, 不能记录时返回None
+        """
+        info = self._template_info(file_name)
+        if info['collection'] or info['related'] or info['assets'] or info['images']:
+            return None
+        refs = set()
+        for name in info['refs']:
+            refs.update(self.includes if name is None else self._template_closure(name))
+        return content_hash(self.markdown_cache.salt, self.config_hash, self.source_hashes.get(file_name, ''),
+                            *sorted(u'%s:%s' % (name, self.source_hashes.get(name)) for name in refs))
+
+    def _convert_post(self, file_name):
+        """
+        渲染文章模板并转换正文
+        :param file_name: 文章文件名
+        :return: (html内容, 首图, 摘要, 标题, 图片列表)
+        """
+        renderer = self._renderer(file_name)
+        raw_content = self._post_text(file_name)
+        # 不同格式的相同正文分别缓存
+        cache_key = u'%s:%s' % (renderer.name, raw_content)
+        result = self.markdown_cache.get(cache_key)
+        if result is None:
+            with self.profiler.phase('markdown', file_name):
+                summary = renderer.extract(raw_content)
+                result = (renderer.render(raw_content), summary['page_image'], summary['description'],
+                          summary['headings'], summary['images'])
+            self.markdown_cache.set(cache_key, result)
+        return result
+
+    def _summarize_post(self, file_name):
+        """
+        流式生成的第一步, 只提取首图, 摘要, 标题和图片, 不保留正文
+        :return: (None, 首图, 摘要, 标题, 图片列表)
+        """
+        renderer = self._renderer(file_name)
+        raw_content = self._post_text(file_name)
+        result = self.markdown_cache.get(u'%s:%s' % (renderer.name, raw_content))
+        if result is not None:
+            return (None,) + tuple(result[1:])
+        summary = renderer.extract(raw_content)
+        return None, summary['page_image'], summary['description'], summary['headings'], summary['images']
+
+    def _load_content(self, post):
+        """
+        按需加载只有摘要的文章正文; 非流式生成时加载后保留到本次构建结束, 不再重复读取
+        """
+        content = self._convert_post(post.source)[0]
+        if not self.stream:
+            post.content = content
+        return content
+
+    def _render_task(self, idx):
+        """
+        渲染待处理列表中的一个页面
+        :return: (输出路径列表, 实际写入的文件数)
+        """
+        self.outputs = []
+        self.written = 0
+        context = self._pending[idx]
+        # 流式生成或部分生成时只有摘要的文章, 渲染前加载正文
+        lazy = context['post'] is not None and context['content'] is None
+        if lazy:
+            context['content'] = context['post'].content
+        with self.profiler.phase('page', context['page'].key):
             self._render_page(context)
+        if lazy:
+            # 输出后丢弃正文
+            context['content'] = None
+        return self.outputs, self.written
+
+    def _map(self, method, tasks):
+        """
+        对每个任务执行生成器方法, jobs大于1时在进程池中并行执行
+        :param method: 方法名
+        :param tasks: [(源文件名, 参数)]
+        :return: 按任务顺序排列的结果
+        """
+        if self.jobs <= 1 or len(tasks) < 2 or not hasattr(os, 'fork'):
+            return [_run_task(self, method, source, item) for source, item in tasks]
+        # fork时生成器直接由初始化参数带入工作进程, 多个线程同时构建时互不影响
+        pool = multiprocessing.Pool(min(self.jobs, len(tasks)), _pool_init, (self,))
+        try:
+            chunk_size = max(1, len(tasks) // (self.jobs * 4))
+            results = []
+            for result, profile_data in pool.map(_pool_task, [(method, source, item) for source, item in tasks],
+                                                 chunk_size):
+                self.profiler.merge(profile_data)
+                results.append(result)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        pool.join()
+        return results
+
+    def _is_listing(self, context):
+        """
+        文章以外列出文章集合的页面: 归档页或模板中使用了site.posts等
+        """
+        if context['post'] is not None:
+            return False
+        return context.get('is_archive') or any(self._template_info(name)['collection']
+                                                for name in self._template_closure(context['page'].key))
+
+    def _load_asset_urls(self):
+        """
+        部分生成时不同步资源, 从上次输出的资源清单读取带哈希的url
+        """
+        self.asset_urls = {}
+        manifest_path = os.path.join(self.output_root, ASSET_MANIFEST)
+        if getattr(self.site, 'asset_fingerprint', False) and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.asset_urls = json.load(f)
+        self.assets_digest = digest_object(self.asset_urls)
+
+    def _outputs_exist(self, entry):
+        base_path = self.output_root
+        return all(os.path.exists(os.path.join(base_path, path)) for path in entry.get('outputs', []))
 
 
 @click.group()
@@ -600,14 +2654,56 @@ author: me
     os.system("open _post/%s" % file_name )
 
 
+def _check_query(ctx, param, value):
+    """
+    --query需为 key=value&key=value 形式
+    """
+    if value is not None:
+        try:
+            parse_query(value)
+        except ValueError:
+            raise click.BadParameter("expected key=value&key=value, got \"%s\"" % value)
+    return value
+
+
 @click.command()
-def gen():
+@click.option('--full', is_flag=True, help='ignore the build manifest and rebuild everything')
+@click.option('--jobs', '-j', default=1, type=int, help='worker processes, 0 means one per CPU')
+@click.option('--profile', is_flag=True, help='record per-phase timings to .bibi/profile.json')
+@click.option('--profile-top', default=10, help='slowest files listed per phase')
+@click.option('--stream', is_flag=True, help='keep only post summaries in memory')
+@click.option('--delta', is_flag=True, help='write outputs changed since the last build to .bibi/delta.json')
+@click.option('--only', multiple=True, help='render only sources matching this glob, may be repeated')
+@click.option('--query', default=None, callback=_check_query, help='render only posts matching key=value&key=value')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='render only posts dated on or after')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='render only posts dated on or before')
+@click.option('--listings', is_flag=True, help='with a partial build, also refresh pages listing posts')
+def gen(full, jobs, profile, profile_top, stream, delta, only, query, since, until, listings):
     """
     生成内容
     :return:
     """
-    generator = Generator()
-    generator.parse_file()
+    select = None
+    if only or query or since or until:
+        if full:
+            raise click.UsageError("--full cannot be combined with --only/--query/--since/--until")
+        select = build_selector(only, query, since, until)
+    generator = Generator(jobs=jobs, profile=profile, stream=stream, delta=delta)
+    try:
+        generator.build(full=full, select=select, listings=listings)
+    except BuildError as e:
+        click.echo("build failed at %s\n%s" % (e.source, e.message), err=True)
+        sys.exit(1)
+    if profile:
+        report = generator.profiler.report(profile_top)
+        with open(os.path.join(generator.root, STATE_FOLDER, PROFILE_FILE), 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        click.echo(generator.profiler.summary(report))
+    if delta:
+        with open(os.path.join(generator.root, STATE_FOLDER, DELTA_FILE), 'w') as f:
+            json.dump(generator.delta, f, indent=2, sort_keys=True)
+        click.echo("delta: %s added, %s changed, %s deleted" % (
+            len(generator.delta['added']), len(generator.delta['changed']), len(generator.delta['deleted'])))
 
     click.echo("all process done")
 
@@ -615,24 +2711,119 @@ def gen():
 @click.command()
 @click.argument('port')
 def test(port):
-    import BaseHTTPServer
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-    os.chdir(os.path.join(os.getcwd(), SITE_FOLDER))
-    HandlerClass = SimpleHTTPRequestHandler
-    ServerClass  = BaseHTTPServer.HTTPServer
-    Protocol = "HTTP/1.0"
-    server_address = ('127.0.0.1', int(port))
-    HandlerClass.protocol_version = Protocol
-    httpd = ServerClass(server_address, HandlerClass)
-    sa = httpd.socket.getsockname()
-    click.echo("Serving HTTP on %s port %s ..." % (sa[0], sa[1]))
-    httpd.serve_forever()
+    """
+    预览站点, 等同于serve
+    """
+    from .server import serve_site
+    serve_site('127.0.0.1', port)
+
+
+@click.command()
+@click.argument('port', default=8000)
+@click.option('--host', default='127.0.0.1', help='address to bind')
+@click.option('--watch', is_flag=True, help='rebuild on source changes and reload the browser')
+@click.option('--cache-size', default=64, help='in-memory cache of hot files, MB')
+@click.option('--quiet', is_flag=True, help='do not log every request')
+@click.option('--stats-interval', default=10, help='seconds between request summaries, 0 only on exit')
+def serve(port, host, watch, cache_size, quiet, stats_interval):
+    """
+    启动站点服务器
+    """
+    from .server import serve_site
+    serve_site(host, port, watch=watch, cache_size=cache_size, quiet=quiet, stats_interval=stats_interval)
+
+
+@click.command()
+@click.option('--posts', '-n', multiple=True, type=int, help='number of synthetic posts, may be repeated')
+@click.option('--jobs', '-j', default=1, type=int, help='worker processes used by each build')
+@click.option('--seed', default=0, help='random seed of the synthetic sites')
+@click.option('--output', '-o', default=None, help='write results to this json file')
+@click.option('--work-dir', default=None, help='generate sites here and keep them')
+@click.option('--images', is_flag=True, help='turn on responsive image derivatives in the sites')
+def bench(posts, jobs, seed, output, work_dir, images):
+    """
+    在模拟站点上测量生成性能
+    """
+    from .bench import benchmark
+    report = benchmark(posts or (100, 1000), jobs=jobs, seed=seed, work_dir=work_dir, keep=work_dir is not None,
+                       resize=images)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data)
+        click.echo("results written to %s" % output)
+    else:
+        click.echo(data)
+
+
+@click.command()
+@click.argument('output', default='site-delta.tar.gz')
+@click.option('--all', 'everything', is_flag=True, help='bundle every output instead of the last delta')
+def bundle(output, everything):
+    """
+    把上次gen --delta记录的增量打包为tar, output为-时写到标准输出
+    """
+    site_root = os.path.join(os.getcwd(), SITE_FOLDER)
+    if everything:
+        manifest = BuildManifest(os.path.join(os.getcwd(), STATE_FOLDER, MANIFEST_FILE))
+        if not manifest.load():
+            raise click.ClickException("no build manifest, run gen first")
+        added = {}
+        for path, record in iteritems(manifest.files):
+            file_path = os.path.join(site_root, path)
+            # 没有使用--delta生成时清单中只有mtime和大小, 打包时再计算哈希
+            if record[2] is None and os.path.isfile(file_path):
+                record = record[:2] + [file_digest(file_path)]
+            added[path] = record[2]
+        delta = dict(added=added, changed={}, deleted=[])
+    else:
+        delta_path = os.path.join(os.getcwd(), STATE_FOLDER, DELTA_FILE)
+        if not os.path.exists(delta_path):
+            raise click.ClickException("no delta, run gen --delta first")
+        with open(delta_path, 'r') as f:
+            delta = json.load(f)
+    if output == '-':
+        count, size = write_bundle(getattr(sys.stdout, 'buffer', sys.stdout), site_root, delta)
+    else:
+        if output.endswith(('.tar.gz', '.tgz')):
+            mode = 'w|gz'
+        elif output.endswith('.tar.bz2'):
+            mode = 'w|bz2'
+        else:
+            mode = 'w|'
+        with open(output, 'wb') as f:
+            count, size = write_bundle(f, site_root, delta, mode)
+    click.echo("bundled %s file(s), %s bytes, %s deleted" % (count, size, len(delta['deleted'])),
+               err=output == '-')
+
+
+@click.group()
+def cache():
+    """
+    管理构建缓存
+    """
+    pass
+
+
+@cache.command()
+def clear():
+    """
+    清空构建缓存
+    """
+    cache_path = os.path.join(os.getcwd(), STATE_FOLDER, CACHE_FOLDER)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    click.echo("cache cleared")
 
 
 def main():
     cli.add_command(project)
+    cli.add_command(cache)
     cli.add_command(gen)
     cli.add_command(test)
+    cli.add_command(serve)
+    cli.add_command(bench)
+    cli.add_command(bundle)
     cli.add_command(new_post)
     cli()
 
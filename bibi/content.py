@@ -0,0 +1,152 @@
+#coding=utf8
+"""
+文章正文处理: 按扩展名选择渲染器, 不含模板语法的文章跳过Jinja,
+首图, 摘要, 标题和图片列表在一次逐行扫描中提取
+"""
+__author__ = 'liming'
+
+import re
+
+import markdown
+from markdown.extensions.toc import slugify, unique
+
+
+# 渲染结果格式变化时修改, 使缓存失效
+CONTENT_VERSION = 1
+TEMPLATE_SYNTAX_RE = re.compile(r'{[{%#]')
+NEWLINE_RE = re.compile(r'\r\n|\r|\n')
+# 首图沿用原有规则: ![alt](url)中的全部内容
+PAGE_IMAGE_RE = re.compile(r'!\[\S*?]\((.+?)\)')
+# 正文中的全部图片url: ![alt](url "title")
+IMAGE_RE = re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)')
+HEADING_RE = re.compile(r'^(#{1,6})(.*?)#*[ \t]*$')
+SETEXT_RE = re.compile(r'^(=+|-+)[ \t]*$')
+FENCE_RE = re.compile(r'^[ \t]{0,3}(`{3,}|~{3,})')
+
+# 扩展名 -> 渲染器类
+CONTENT_RENDERERS = {}
+
+
+def register_renderer(renderer):
+    """
+    注册文章渲染器, 可作为类装饰器使用; 相同扩展名的渲染器后注册的生效
+    """
+    for ext in renderer.extensions:
+        CONTENT_RENDERERS[ext.lstrip('.').lower()] = renderer
+    return renderer
+
+
+def has_template_syntax(text):
+    return TEMPLATE_SYNTAX_RE.search(text) is not None
+
+
+def plain_text(text):
+    """
+    不含模板语法的正文, 结果与经过Jinja渲染相同: 统一换行符, 去掉末尾的一个换行
+    """
+    text = NEWLINE_RE.sub(u'\n', text)
+    if text.endswith(u'\n'):
+        text = text[:-1]
+    return text
+
+
+def scan_markdown(text):
+    """
+    逐行扫描一次markdown正文
+    :return: dict(page_image=首图, description=摘要, headings=[标题], images=[图片url])
+    """
+    page_image = None
+    description = None
+    headings = []
+    images = []
+    used_ids = set()
+    fence = None
+    previous = u''
+    for line in text.split(u'\n'):
+        has_image = False
+        if u'![' in line:
+            if page_image is None:
+                match = PAGE_IMAGE_RE.search(line)
+                if match:
+                    page_image = match.group(1)
+                    has_image = True
+            else:
+                has_image = PAGE_IMAGE_RE.search(line) is not None
+            images.extend(IMAGE_RE.findall(line))
+        if description is None and line.strip() and not has_image:
+            description = line
+
+        match = FENCE_RE.match(line)
+        if fence is not None:
+            if match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence):
+                fence = None
+            previous = u''
+            continue
+        if match:
+            fence = match.group(1)
+            previous = u''
+            continue
+        heading = None
+        match = HEADING_RE.match(line)
+        if match and match.group(2).strip():
+            heading = (len(match.group(1)), match.group(2).strip())
+        elif previous.strip() and not previous.startswith(u'    ') and SETEXT_RE.match(line):
+            heading = (1 if line[0] == u'=' else 2, previous.strip())
+        if heading:
+            level, title = heading
+            headings.append(dict(level=level, text=title, id=unique(slugify(title, u'-'), used_ids)))
+            previous = u''
+        else:
+            previous = line
+    return dict(page_image=page_image or '', description=description, headings=headings, images=images)
+
+
+class ContentRenderer(object):
+    """
+    文章渲染器基类, 子类设置extensions并实现render, 用register_renderer注册
+    """
+    name = None
+    extensions = ()
+
+    def __init__(self, site):
+        """
+        :param site: 站点对象, 可从中读取配置
+        """
+        self.site = site
+
+    @property
+    def salt(self):
+        """
+        影响渲染结果的版本和配置, 变化时缓存失效
+        """
+        return [self.name]
+
+    def render(self, text):
+        """
+        :return: 正文html
+        """
+        raise NotImplementedError
+
+    def extract(self, text):
+        """
+        :return: dict(page_image, description, headings, images)
+        """
+        return scan_markdown(text)
+
+
+@register_renderer
+class MarkdownRenderer(ContentRenderer):
+    name = 'markdown'
+    extensions = ('md', 'markdown')
+
+    def __init__(self, site):
+        super(MarkdownRenderer, self).__init__(site)
+        self.markdown_extensions = getattr(site, 'markdown_extensions', [])
+
+    @property
+    def salt(self):
+        return [self.name, getattr(markdown, '__version__', getattr(markdown, 'version', '')),
+                self.markdown_extensions]
+
+    def render(self, text):
+        return markdown.markdown(text, extensions=self.markdown_extensions)
@@ -0,0 +1,146 @@
+#coding=utf8
+"""
+响应式图片: 为文章中用到的图片生成缩略图和多种宽度的缩小图(可选WebP),
+结果按源文件哈希和参数缓存, 模板通过srcset和thumbnail过滤器引用
+"""
+__author__ = 'liming'
+
+import io
+import os
+import json
+import shutil
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .bibi import write_if_changed, write_json, digest_object, content_hash
+
+
+IMAGE_FOLDER = 'resized'
+IMAGE_EXTS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+IMAGE_WIDTHS = [320, 640, 1024]
+THUMBNAIL_SIZE = 240
+IMAGE_QUALITY = 80
+IMAGE_VERSION = 1
+META_FILE = 'meta.json'
+SAVE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'webp': 'WEBP'}
+
+
+def image_path(url):
+    """
+    站内图片url对应的资源相对路径, 外部图片和非图片返回None
+    """
+    if not url or '//' in url or ':' in url.split('/')[0]:
+        return None
+    path = url.split('?')[0].split('#')[0].lstrip('/')
+    if os.path.splitext(path)[1][1:].lower() not in IMAGE_EXTS:
+        return None
+    return path
+
+
+def image_params(config):
+    """
+    :return: 规范化的生成参数, 参数变化时缓存随之失效
+    """
+    if not isinstance(config, dict):
+        config = {}
+    return dict(widths=sorted(int(width) for width in config.get('widths', IMAGE_WIDTHS)),
+                thumbnail=int(config.get('thumbnail', THUMBNAIL_SIZE)),
+                quality=int(config.get('quality', IMAGE_QUALITY)),
+                webp=bool(config.get('webp', False)),
+                version=IMAGE_VERSION)
+
+
+def _save(image, path, ext, quality):
+    save_format = SAVE_FORMATS[ext]
+    if save_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    options = dict(optimize=True)
+    if save_format in ('JPEG', 'WEBP'):
+        options['quality'] = quality
+    if save_format == 'JPEG':
+        options['progressive'] = True
+    buf = io.BytesIO()
+    image.save(buf, save_format, **options)
+    write_if_changed(path, buf.getvalue())
+
+
+def resize_image(task):
+    """
+    生成一张图片的全部衍生图, 在进程池中执行
+    :param task: (源文件路径, 缓存目录, 参数)
+    :return: 衍生图信息, 图片无法读取时返回None
+    """
+    src_path, cache_dir, params = task
+    try:
+        source = Image.open(src_path)
+        source.load()
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    ext = os.path.splitext(src_path)[1][1:].lower()
+    if ext == 'gif' and getattr(source, 'is_animated', False):
+        # 动图缩放后会丢失动画, 只生成缩略图
+        widths = []
+    else:
+        widths = [width for width in params['widths'] if width < source.size[0]]
+    formats = [ext] + (['webp'] if params['webp'] and ext != 'webp' else [])
+    variants = []
+    for label, size in [('thumb', None)] + [('%sw' % width, width) for width in widths]:
+        if size is None:
+            image = source.copy()
+            image.thumbnail((params['thumbnail'], params['thumbnail']), Image.LANCZOS)
+        else:
+            height = max(1, int(round(source.size[1] * float(size) / source.size[0])))
+            image = source.resize((size, height), Image.LANCZOS)
+        for image_format in formats:
+            file_name = '%s.%s' % (label, image_format)
+            _save(image, os.path.join(cache_dir, file_name), image_format, params['quality'])
+            variants.append([label, image_format, image.size[0], file_name])
+    meta = dict(size=list(source.size), variants=variants)
+    write_json(os.path.join(cache_dir, META_FILE), meta)
+    return meta
+
+
+class ImageCache(object):
+    """
+    衍生图缓存, 每张源图一个目录, 以源文件哈希和参数命名
+    """
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.salt = digest_object(params)
+
+    def key(self, digest):
+        return content_hash(self.salt, digest)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: 衍生图信息, 未缓存时返回None
+        """
+        try:
+            with open(os.path.join(self.entry_path(key), META_FILE), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def evict(self, keys):
+        """
+        删除不在keys中的缓存
+        """
+        keys = set(keys)
+        if not os.path.isdir(self.path):
+            return
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                if key not in keys:
+                    shutil.rmtree(os.path.join(prefix_path, key), ignore_errors=True)
@@ -0,0 +1,160 @@
+#coding=utf8
+"""
+相关文章: 按共同标签(可选再加标题和摘要的TF-IDF)为每篇文章计算最相关的K篇,
+候选文章来自倒排索引, 增量构建只重新计算受变化影响的文章
+"""
+__author__ = 'liming'
+
+import json
+import math
+
+from six import iteritems
+
+from .bibi import write_json, digest_object
+from .search import tokenize
+
+
+RELATED_LIMIT = 5
+RELATED_VERSION = 1
+# 出现在超过该比例文章中的词不参与TF-IDF, 避免候选集合退化为全部文章
+RELATED_MAX_DF = 0.2
+TEXT_WEIGHT = 1.0
+
+
+def idf(df):
+    """
+    词的权重随出现的文章数递减; 不依赖文章总数, 新增文章只影响含有相同标签或词的文章
+    """
+    return 1.0 / math.log(1 + df)
+
+
+class RelatedIndex(object):
+    """
+    相关文章索引, 上次的特征和结果缓存在磁盘上
+    """
+    def __init__(self, cache_path, limit=RELATED_LIMIT, text=False, max_df=RELATED_MAX_DF, load=True):
+        """
+        :param load: 是否读取缓存, 全量生成时为False, 全部重新计算
+        """
+        self.cache_path = cache_path
+        self.limit = limit
+        self.text = text
+        self.max_df = max_df
+        self.key = digest_object([RELATED_VERSION, limit, text, max_df])
+        self.docs = {}
+        self.related = {}
+        self.computed = 0
+        # 特征或结果与缓存不同, 需要保存
+        self.dirty = False
+        if not load:
+            return
+        try:
+            with open(cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == self.key:
+                self.docs = data['docs']
+                self.related = data['related']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def features(self, post):
+        """
+        :return: [排序后的标签, {词: 词频}]
+        """
+        tags = sorted(tag for tag in post.tags if tag.strip())
+        terms = {}
+        if self.text:
+            for token in tokenize(u'%s %s' % (post.title or u'', post.description or u'')):
+                terms[token] = terms.get(token, 0) + 1
+        return [tags, terms]
+
+    def _vocabulary(self, docs):
+        """
+        :return: (标签文档频率, 词文档频率, 参与计算的词)
+        """
+        tag_df = {}
+        term_df = {}
+        for tags, terms in docs.values():
+            for tag in tags:
+                tag_df[tag] = tag_df.get(tag, 0) + 1
+            for term in terms:
+                term_df[term] = term_df.get(term, 0) + 1
+        limit = max(2, int(len(docs) * self.max_df))
+        return tag_df, term_df, set(term for term, df in iteritems(term_df) if df <= limit)
+
+    def update(self, posts):
+        """
+        计算全部文章的相关文章, 并设置post.related
+        :param posts: 全部文章
+        """
+        by_url = dict((post.url, post) for post in posts)
+        docs = dict((post.url, self.features(post)) for post in posts)
+        tag_df, term_df, vocabulary = self._vocabulary(docs)
+
+        # 变化的文章及其新旧标签和词, 含有这些特征的文章需要重新计算
+        changed = set(url for url in set(docs) | set(self.docs) if docs.get(url) != self.docs.get(url))
+        dirty_tags = set()
+        dirty_terms = set()
+        for url in changed:
+            for features in (docs.get(url), self.docs.get(url)):
+                if features:
+                    dirty_tags.update(features[0])
+                    dirty_terms.update(features[1])
+        if self.text and self.docs and changed:
+            # 文章数变化可能使某些词越过阈值
+            _, _, old_vocabulary = self._vocabulary(self.docs)
+            dirty_terms.update(old_vocabulary ^ vocabulary)
+
+        tag_posts = {}
+        term_posts = {}
+        for url, (tags, terms) in iteritems(docs):
+            for tag in tags:
+                tag_posts.setdefault(tag, []).append(url)
+            for term in terms:
+                if term in vocabulary:
+                    term_posts.setdefault(term, []).append(url)
+
+        pending = set(url for url in docs if url in changed or url not in self.related)
+        for tag in dirty_tags:
+            pending.update(tag_posts.get(tag, ()))
+        if dirty_terms:
+            # 词的文档频率变化后, 含有该词的文章的向量重新归一化,
+            # 与这些文章有任一共同词的文章分数都会变化
+            normalized = set(url for url, (_, terms) in iteritems(docs) if not dirty_terms.isdisjoint(terms))
+            pending.update(normalized)
+            for url in normalized:
+                for term in docs[url][1]:
+                    pending.update(term_posts.get(term, ()))
+
+        vectors = {}
+        if self.text and pending:
+            for url in docs:
+                vector = dict((term, count * idf(term_df[term]))
+                              for term, count in iteritems(docs[url][1]) if term in vocabulary)
+                norm = math.sqrt(sum(value * value for value in vector.values()))
+                vectors[url] = dict((term, value / norm) for term, value in iteritems(vector)) if norm else {}
+
+        related = dict((url, self.related[url]) for url in docs if url not in pending)
+        for url in pending:
+            scores = {}
+            for tag in docs[url][0]:
+                weight = idf(tag_df[tag])
+                for other in tag_posts[tag]:
+                    scores[other] = scores.get(other, 0) + weight
+            if self.text:
+                for term, value in iteritems(vectors[url]):
+                    for other in term_posts[term]:
+                        scores[other] = scores.get(other, 0) + TEXT_WEIGHT * value * vectors[other][term]
+            scores.pop(url, None)
+            # 分数相同时新文章在前
+            ranked = sorted(scores, key=lambda other: (-scores[other], -by_url[other].date.toordinal(), other))
+            related[url] = ranked[:self.limit]
+        self.computed = len(pending)
+        self.dirty = bool(changed or pending)
+        self.docs = docs
+        self.related = related
+        for post in posts:
+            post.related = [by_url[url] for url in related[post.url]]
+
+    def save(self):
+        write_json(self.cache_path, dict(key=self.key, docs=self.docs, related=self.related))
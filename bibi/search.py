@@ -0,0 +1,218 @@
+#coding=utf8
+"""
+站内搜索: 对文章标题, 标签和正文分词, 生成按词分片的倒排索引, 浏览器只加载查询用到的分片
+"""
+__author__ = 'liming'
+
+import re
+import json
+
+from six import iteritems, text_type
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+from .bibi import write_json, gzip_bytes
+
+
+SEARCH_FOLDER = 'search'
+SEARCH_SHARDS = 16
+SEARCH_VERSION = 2
+# 标题, 标签, 正文中出现一次的权重
+FIELD_WEIGHTS = (5, 3, 1)
+CJK_RANGES = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+# 中日韩文字连续的一段, 或其他文字和数字组成的词
+TOKEN_RE = re.compile(u'([%s]+)|[^\\W_%s]+' % (CJK_RANGES, CJK_RANGES), re.UNICODE)
+HTML_TAG_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]+>', re.S | re.I)
+
+SEARCH_SCRIPT = u"""(function (global) {
+  var script = document.currentScript;
+  var base = script ? script.src.replace(/[^\\/]*$/, '') : '/search/';
+  var CJK = '%s';
+  var TOKEN = new RegExp('([' + CJK + ']+)|(?:(?![' + CJK + '])[\\\\p{L}\\\\p{N}])+', 'gu');
+  var files = {};
+
+  function load(name) {
+    if (!files[name]) {
+      files[name] = fetch(base + name).then(function (r) { return r.json(); });
+    }
+    return files[name];
+  }
+
+  function tokenize(text) {
+    var tokens = [], match, run, i;
+    text = text.toLowerCase();
+    TOKEN.lastIndex = 0;
+    while ((match = TOKEN.exec(text))) {
+      run = match[1];
+      if (!run) {
+        tokens.push(match[0]);
+      } else if (run.length === 1) {
+        tokens.push(run);
+      } else {
+        for (i = 0; i < run.length - 1; i++) tokens.push(run.substr(i, 2));
+      }
+    }
+    return tokens.filter(function (token, idx) { return tokens.indexOf(token) === idx; });
+  }
+
+  function shard(term, shards) {
+    var h = 0;
+    for (var i = 0; i < term.length; i++) h = (Math.imul(h, 31) + term.charCodeAt(i)) >>> 0;
+    return h %% shards;
+  }
+
+  function search(query, limit) {
+    var terms = tokenize(query);
+    if (!terms.length) return Promise.resolve([]);
+    return load('meta.json').then(function (meta) {
+      var names = terms.map(function (term) { return 'shard-' + shard(term, meta.shards) + '.json'; });
+      return Promise.all([load('docs.json')].concat(names.map(load)));
+    }).then(function (parts) {
+      var docs = parts[0], scores = null;
+      terms.forEach(function (term, idx) {
+        var postings = parts[idx + 1][term] || [], found = {}, doc = 0, i;
+        for (i = 0; i < postings.length; i += 2) {
+          doc += postings[i];
+          found[doc] = postings[i + 1];
+        }
+        if (scores === null) {
+          scores = found;
+          return;
+        }
+        Object.keys(scores).forEach(function (key) {
+          if (key in found) scores[key] += found[key];
+          else delete scores[key];
+        });
+      });
+      return Object.keys(scores).sort(function (a, b) { return scores[b] - scores[a]; })
+        .slice(0, limit || 20).map(function (key) {
+          var doc = docs[key];
+          return {url: doc[0], title: doc[1], date: doc[2], score: scores[key]};
+        });
+    });
+  }
+
+  global.bibiSearch = {search: search, tokenize: tokenize};
+})(this);
+""" % CJK_RANGES.encode('unicode_escape').decode('ascii')
+
+
+def tokenize(text):
+    """
+    分词: 其他文字按词切分并转小写, 中日韩文字切成相邻两字的二元组
+    """
+    tokens = []
+    for match in TOKEN_RE.finditer(text.lower()):
+        run = match.group(1)
+        if run is None:
+            tokens.append(match.group(0))
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[idx:idx + 2] for idx in range(len(run) - 1))
+    return tokens
+
+
+def strip_html(html):
+    """
+    去掉html标签, 脚本和样式, 还原实体
+    """
+    return unescape(HTML_TAG_RE.sub(u' ', html))
+
+
+def document_terms(title, tags, html):
+    """
+    :return: {词: 加权词频}
+    """
+    terms = {}
+    for text, weight in zip((title or u'', u' '.join(tags or ()), strip_html(html or u'')), FIELD_WEIGHTS):
+        for token in tokenize(text):
+            terms[token] = terms.get(token, 0) + weight
+    return terms
+
+
+def shard_of(term, shards):
+    """
+    词所在的分片, 与search.js一致: 按UTF-16编码单元计算 h = h * 31 + c
+    """
+    h = 0
+    data = term.encode('utf-16-le')
+    for idx in range(0, len(data), 2):
+        h = (h * 31 + (ord(data[idx:idx + 1]) | ord(data[idx + 1:idx + 2]) << 8)) & 0xffffffff
+    return h % shards
+
+
+def dump_json(obj):
+    return text_type(json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=True)).encode('utf-8')
+
+
+class SearchIndex(object):
+    """
+    搜索索引, 每篇文章的词频按内容哈希缓存, 文章变化时只重新分词变化的文章
+    """
+    def __init__(self, cache_path, shards=SEARCH_SHARDS):
+        self.cache_path = cache_path
+        self.shards = shards
+        self.cache = {}
+        self.docs = []
+        self.terms = []
+        self.used = {}
+        self.tokenized = 0
+        try:
+            with open(cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == SEARCH_VERSION:
+                self.cache = data['docs']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def add(self, key, url, title, date, loader):
+        """
+        加入一篇文章
+        :param key: 文章内容的哈希
+        :param loader: 缓存未命中时调用, 返回(标题, 标签, html正文)
+        """
+        terms = self.cache.get(key)
+        if terms is None:
+            terms = document_terms(*loader())
+            self.tokenized += 1
+        self.used[key] = terms
+        self.docs.append([url, title or u'', date.strftime('%Y-%m-%d') if date else u''])
+        self.terms.append(terms)
+
+    def build(self):
+        """
+        生成索引文件, 倒排表为[文档号差值, 权重, ...]; 分片另写一份gzip压缩的.gz,
+        不开启precompress时服务器也能直接发送压缩的分片
+        :return: {相对于搜索目录的文件名: 内容}
+        """
+        shards = [{} for _ in range(self.shards)]
+        for doc_id, terms in enumerate(self.terms):
+            for term, weight in iteritems(terms):
+                shard = shards[shard_of(term, self.shards)]
+                postings = shard.get(term)
+                if postings is None:
+                    shard[term] = [doc_id, weight, doc_id]
+                else:
+                    postings[-1:] = [doc_id - postings[-1], weight, doc_id]
+        files = {}
+        for idx, shard in enumerate(shards):
+            for postings in shard.values():
+                # 最后一项是上一个文档号, 只在构建时使用
+                postings.pop()
+            files['shard-%s.json' % idx] = dump_json(shard)
+            files['shard-%s.json.gz' % idx] = gzip_bytes(files['shard-%s.json' % idx])
+        files['docs.json'] = dump_json(self.docs)
+        files['meta.json'] = dump_json(dict(version=SEARCH_VERSION, shards=self.shards, docs=len(self.docs)))
+        files['search.js'] = SEARCH_SCRIPT.encode('utf-8')
+        return files
+
+    def save(self):
+        """
+        保存本次用到的文章词频, 不再存在的文章随之删除
+        """
+        write_json(self.cache_path, dict(version=SEARCH_VERSION, docs=self.used))
@@ -0,0 +1,479 @@
+#coding=utf8
+"""
+站点服务器: HTTP/1.1长连接, 条件请求, 预压缩文件和内存缓存;
+预览时可监视源文件并增量重新生成
+"""
+__author__ = 'liming'
+
+import os
+import time
+import shutil
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from timeit import default_timer
+
+import click
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit, urlunsplit
+
+from .bibi import (Generator, BuildError, SITE_FOLDER, POSTS_FOLDER, LAYOUTS_FOLDER,
+                   INCLUDE_FOLDER, ASSETS_FOLDER, CONFIG)
+
+
+WATCH_FOLDERS = [POSTS_FOLDER, LAYOUTS_FOLDER, INCLUDE_FOLDER, ASSETS_FOLDER]
+ROOT_EXTS = ['.html', '.htm', '.xml', '.md', '.markdown']
+RELOAD_PATH = '/__bibi__/reload'
+RELOAD_SCRIPT = (u'<script>(function(){var s=new EventSource("%s");'
+                 u's.onmessage=function(){location.reload();};})();</script>' % RELOAD_PATH)
+# 客户端接受的编码和对应的预压缩文件后缀, 按优先顺序
+ENCODINGS = [('br', 'br'), ('gzip', 'gz')]
+INDEX_FILES = ['index.html', 'index.htm']
+FILE_CACHE_SIZE = 64  # MB
+# 超过此大小的文件不进入内存缓存, 直接从磁盘输出
+FILE_CACHE_MAX_FILE = 4 * 1024 * 1024
+STATS_INTERVAL = 10
+
+
+class BuildNotifier(object):
+    """
+    记录构建版本, 浏览器通过长连接等待新版本
+    """
+    def __init__(self):
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """
+        等待版本号超过version
+        :return: 当前版本号
+        """
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+            return self.version
+
+
+class Watcher(object):
+    """
+    轮询源文件的mtime和大小, 合并短时间内的连续修改
+    """
+    def __init__(self, root, interval=0.3, debounce=0.2):
+        self.root = root
+        self.interval = interval
+        self.debounce = debounce
+
+    def snapshot(self):
+        state = {}
+        for folder in WATCH_FOLDERS:
+            for dir_path, _, file_names in os.walk(os.path.join(self.root, folder)):
+                for file_name in file_names:
+                    self._stat(state, os.path.join(dir_path, file_name))
+        for file_name in os.listdir(self.root):
+            if file_name == CONFIG or os.path.splitext(file_name)[1] in ROOT_EXTS:
+                self._stat(state, os.path.join(self.root, file_name))
+        return state
+
+    def _stat(self, state, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        state[path] = (stat.st_mtime, stat.st_size)
+
+    def watch(self, callback):
+        """
+        持续监视, 有变化且稳定后调用callback(变化的路径列表)
+        """
+        state = self.snapshot()
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            if current == state:
+                continue
+            # 等待连续的修改结束
+            while True:
+                time.sleep(self.debounce)
+                latest = self.snapshot()
+                if latest == current:
+                    break
+                current = latest
+            changed = sorted(path for path in set(state) | set(current)
+                             if state.get(path) != current.get(path))
+            state = current
+            callback(changed)
+
+
+class FileCache(object):
+    """
+    最近访问文件的内存缓存, 总大小有上限, 超出时淘汰最久未访问的文件;
+    每次访问比较mtime和大小, 文件变化后重新读取
+    """
+    def __init__(self, max_size, max_file_size=FILE_CACHE_MAX_FILE):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, stat):
+        """
+        :return: 文件内容, 文件太大不缓存时返回None
+        """
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                    self.entries[path] = entry
+                    self.hits += 1
+                    return entry[2]
+                self.size -= len(entry[2])
+            self.misses += 1
+        if stat.st_size > min(self.max_file_size, self.max_size):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) != stat.st_size:
+            # 读取时文件正在被替换, 不缓存
+            return data
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = (stat.st_mtime, stat.st_size, data)
+                self.size += len(data)
+                while self.size > self.max_size:
+                    _, old = self.entries.popitem(last=False)
+                    self.size -= len(old[2])
+        return data
+
+
+class RequestStats(object):
+    """
+    统计请求数, 状态码和处理延迟
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.total = 0
+        self._reset()
+
+    def _reset(self):
+        self.window_started = time.time()
+        self.latencies = []
+        self.statuses = {}
+
+    def record(self, status, seconds):
+        with self.lock:
+            self.total += 1
+            self.latencies.append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self, file_cache=None):
+        """
+        上次摘要以来的请求速率和延迟分位数, 没有请求时返回None
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            statuses = self.statuses
+            elapsed = time.time() - self.window_started
+            self._reset()
+        if not latencies:
+            return None
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        text = "%s requests in %.1fs (%.1f req/s), latency p50 %.2fms p95 %.2fms p99 %.2fms max %.2fms, %s" % (
+            len(latencies), elapsed, len(latencies) / max(elapsed, 1e-6), percentile(0.5),
+            percentile(0.95), percentile(0.99), latencies[-1] * 1000,
+            ' '.join('%s:%s' % item for item in sorted(statuses.items())))
+        if file_cache is not None and file_cache.hits + file_cache.misses:
+            text += ", cache hit %.1f%%" % (100.0 * file_cache.hits / (file_cache.hits + file_cache.misses))
+        return text
+
+    def report(self, interval, file_cache=None):
+        """
+        每interval秒输出一次摘要
+        """
+        while True:
+            time.sleep(interval)
+            text = self.summary(file_cache)
+            if text:
+                click.echo(text, err=True)
+
+
+class SiteRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    从站点目录提供文件, 开启监视时向html注入自动刷新脚本
+    """
+    protocol_version = 'HTTP/1.1'
+    # 响应头和内容缓冲后一起发送, 关闭Nagle算法, 避免长连接上小响应等待延迟确认
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.site_root, os.path.relpath(path, os.getcwd()))
+
+    def handle_one_request(self):
+        self._status = None
+        start = default_timer()
+        SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+        if self._status is not None and getattr(self, 'path', None) != RELOAD_PATH:
+            self.server.stats.record(self._status, default_timer() - start)
+
+    def send_response(self, code, message=None):
+        self._status = code
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_error(self, code, message=None):
+        # 错误响应不一定带Content-Length, 发送后关闭连接, 避免长连接的客户端等待
+        self.close_connection = True
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_error(self, code, message)
+        self.close_connection = True
+
+    def do_GET(self):
+        notifier = self.server.notifier
+        if notifier is not None and self.path == RELOAD_PATH:
+            return self._send_events(notifier)
+        path = self._resolve(self.translate_path(self.path))
+        if path is None:
+            return
+        if os.path.isdir(path):
+            return self._send_directory(path)
+        if notifier is not None and os.path.splitext(path)[1] in ('.html', '.htm'):
+            return self._send_html(path)
+        return self._send_file(path)
+
+    def do_HEAD(self):
+        path = self._resolve(self.translate_path(self.path))
+        if path is None:
+            return
+        if os.path.isdir(path):
+            return self._send_directory(path, head=True)
+        return self._send_file(path, head=True)
+
+    def _resolve(self, path):
+        """
+        请求对应的文件, 目录返回其中的index.html, 没有时返回目录本身;
+        缺少末尾斜杠的目录和不存在的文件在这里直接响应
+        :return: 文件或目录路径, 已响应时返回None
+        """
+        if os.path.isdir(path):
+            parts = urlsplit(self.path)
+            if not parts.path.endswith('/'):
+                self.send_response(301)
+                self.send_header('Location', urlunsplit((parts[0], parts[1], parts[2] + '/', parts[3], parts[4])))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            for index in INDEX_FILES:
+                if os.path.isfile(os.path.join(path, index)):
+                    return os.path.join(path, index)
+            return path
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        return path
+
+    def _send_directory(self, path, head=False):
+        """
+        目录列表, list_directory已发送带Content-Length的响应头
+        """
+        f = self.list_directory(path)
+        if f is None:
+            return
+        try:
+            if not head:
+                shutil.copyfileobj(f, self.wfile)
+        finally:
+            f.close()
+
+    def _accepted_encodings(self):
+        encodings = set()
+        for part in self.headers.get('Accept-Encoding', '').split(','):
+            params = [item.strip() for item in part.split(';')]
+            if params[0] and 'q=0' not in params[1:]:
+                encodings.add(params[0].lower())
+        return encodings
+
+    def _not_modified(self, etag, mtime):
+        """
+        按If-None-Match或If-Modified-Since判断客户端缓存是否有效
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            parsed = parsedate_tz(if_modified_since)
+            if parsed is not None:
+                return int(mtime) <= mktime_tz(parsed)
+        return False
+
+    def _send_file(self, path, head=False):
+        """
+        输出文件: 客户端支持时使用不早于原文件的.br/.gz预压缩文件, 支持ETag和Last-Modified
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return self.send_error(404, "File not found")
+        file_path, file_stat, encoding, compressed = path, stat, None, False
+        accepted = self._accepted_encodings()
+        for name, ext in ENCODINGS:
+            try:
+                sibling_stat = os.stat('%s.%s' % (path, ext))
+            except OSError:
+                continue
+            if sibling_stat.st_mtime < stat.st_mtime:
+                continue
+            compressed = True
+            if encoding is None and name in accepted:
+                file_path, file_stat, encoding = '%s.%s' % (path, ext), sibling_stat, name
+        etag = '"%x-%x%s"' % (int(file_stat.st_mtime * 1000000), file_stat.st_size,
+                              '-' + encoding if encoding else '')
+        if self._not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(int(stat.st_mtime)))
+            if compressed:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        data = None if head else self.server.file_cache.get(file_path, file_stat)
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(data) if data is not None else file_stat.st_size))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(int(stat.st_mtime)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if compressed:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if head:
+            return
+        if data is not None:
+            self.wfile.write(data)
+        else:
+            with open(file_path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def _send_html(self, path):
+        with open(path, 'rb') as f:
+            html = f.read().decode('utf-8')
+        idx = html.rfind(u'</body>')
+        if idx < 0:
+            idx = len(html)
+        body = (html[:idx] + RELOAD_SCRIPT + html[idx:]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_events(self, notifier):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        version = notifier.version
+        try:
+            while True:
+                current = notifier.wait(version, 15)
+                if current != version:
+                    version = current
+                    self.wfile.write(('data: %s\n\n' % version).encode('ascii'))
+                else:
+                    # 心跳, 用于发现已断开的连接
+                    self.wfile.write(b': ping\n\n')
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+
+
+class SiteServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    多线程的站点服务器
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, site_root, notifier=None, cache_size=FILE_CACHE_SIZE, quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SiteRequestHandler)
+        self.site_root = site_root
+        self.notifier = notifier
+        self.file_cache = FileCache(cache_size * 1024 * 1024)
+        self.stats = RequestStats()
+        self.quiet = quiet
+
+
+def rebuild(generator, notifier, changed):
+    """
+    刷新常驻生成器并增量生成, 只重新读取变化的源文件, 完成后通知浏览器刷新
+    """
+    click.echo("%s file(s) changed, rebuilding..." % len(changed))
+    start = time.time()
+    try:
+        generator.build(changed=changed)
+    except BuildError as e:
+        click.echo("build failed at %s\n%s" % (e.source, e.message), err=True)
+        return
+    except Exception as e:
+        click.echo("build failed: %s" % e, err=True)
+        return
+    click.echo("rebuilt in %.3fs" % (time.time() - start))
+    notifier.notify()
+
+
+def serve_site(host, port, watch=False, cache_size=FILE_CACHE_SIZE, quiet=False, stats_interval=STATS_INTERVAL):
+    """
+    启动服务器, watch为True时监视源文件并自动重新生成
+    :param cache_size: 内存缓存大小, MB
+    :param quiet: 不输出每个请求的日志
+    :param stats_interval: 输出请求统计的间隔秒数, 0为只在退出时输出
+    """
+    root = os.getcwd()
+    notifier = None
+    if watch:
+        notifier = BuildNotifier()
+        generator = Generator(root=root)
+        generator.build()
+        watcher = Watcher(root)
+        thread = threading.Thread(target=watcher.watch,
+                                  args=(lambda changed: rebuild(generator, notifier, changed),))
+        thread.daemon = True
+        thread.start()
+    httpd = SiteServer((host, int(port)), os.path.join(root, SITE_FOLDER), notifier, cache_size, quiet)
+    if stats_interval:
+        thread = threading.Thread(target=httpd.stats.report, args=(stats_interval, httpd.file_cache))
+        thread.daemon = True
+        thread.start()
+    sa = httpd.socket.getsockname()
+    click.echo("Serving HTTP on %s port %s ..." % (sa[0], sa[1]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        text = httpd.stats.summary(httpd.file_cache)
+        if text:
+            click.echo(text, err=True)
+        click.echo("%s requests in %.1fs" % (httpd.stats.total, time.time() - httpd.stats.started), err=True)
@@ -18,6 +18,10 @@ setup(name='bibi',
           'PyYAML',
           'six'
       ],
+      extras_require={
+          'brotli': ['brotli'],
+          'images': ['Pillow'],
+      },
       entry_points = {
         'console_scripts': ['bibi=bibi.bibi:main'],
       },